@@ -0,0 +1,255 @@
+import hashlib
+import os
+import queue
+from contextlib import contextmanager
+
+import cv2
+import cv2.dnn
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:  # onnxruntime is optional, cv2.dnn works without it
+    ort = None
+
+# Per-process thread budget set by set_inference_threads, e.g. in each pre-forked worker
+_inference_threads = None
+
+
+def set_inference_threads(threads):
+    """
+    Limits inference in this process to threads threads.
+
+    Applies to OpenCV straight away and to onnxruntime sessions opened from now on,
+    which includes sessions reopened after a fork.
+    """
+    global _inference_threads
+    _inference_threads = threads
+    cv2.setNumThreads(threads)
+
+
+class CvDnnBackend:
+    """
+    Runs an ONNX model through OpenCV's dnn module.
+
+    Args:
+        model_path (str): Path to the ONNX weights.
+        threads (int): Number of OpenCV worker threads. OpenCV only has a process-wide
+            setting, so the last model loaded with this option wins.
+    """
+
+    name = "cv2"
+
+    def __init__(self, model_path, threads=None):
+        self.model_path = model_path
+        if threads is not None:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        # Cleared the first time the net rejects a batch, so later calls go straight to slices
+        self.batched = True
+
+    def forward(self, blob):
+        """
+        Runs the net over a batch blob with a single forward where the network allows it.
+
+        Nets exported with a fixed batch size of 1 reject larger inputs, so those fall
+        back to one forward per image over slices of the same blob. The first rejection
+        is remembered and the batched attempt is not repeated.
+
+        Args:
+            blob (numpy.ndarray): NCHW input blob.
+
+        Returns:
+            numpy.ndarray: Raw outputs of shape (N, 4 + num_classes, num_anchors).
+        """
+        if len(blob) > 1 and self.batched:
+            try:
+                self.net.setInput(blob)
+                outputs = self.net.forward()
+                if outputs.shape[0] == len(blob):
+                    return outputs
+            except cv2.error:
+                pass
+            self.batched = False
+
+        outputs = []
+        for i in range(len(blob)):
+            self.net.setInput(blob[i:i + 1])
+            outputs.append(self.net.forward())
+        return np.concatenate(outputs)
+
+
+class OnnxRuntimeBackend:
+    """
+    Runs an ONNX model in an ONNX Runtime CPU session.
+
+    The session's thread pools do not survive fork, so a forked process opens its own
+    session on first use instead of using the one inherited from its parent.
+
+    Args:
+        model_path (str): Path to the ONNX weights.
+        intra_op_threads (int): Threads used inside a single operator (0 lets ORT decide).
+        inter_op_threads (int): Threads used to run independent operators in parallel.
+        graph_optimization (str): One of "disable", "basic", "extended" or "all".
+        parallel (bool): Use the parallel executor instead of the sequential one.
+        providers (list[str]): Execution providers, in order of preference.
+    """
+
+    name = "onnxruntime"
+
+    OPTIMIZATION_LEVELS = {
+        "disable": "ORT_DISABLE_ALL",
+        "basic": "ORT_ENABLE_BASIC",
+        "extended": "ORT_ENABLE_EXTENDED",
+        "all": "ORT_ENABLE_ALL",
+    }
+
+    def __init__(self, model_path, intra_op_threads=0, inter_op_threads=0, graph_optimization="all",
+                 parallel=False, providers=("CPUExecutionProvider",)):
+        if ort is None:
+            raise ImportError("onnxruntime is not installed; pip install onnxruntime to use this backend")
+        if graph_optimization not in self.OPTIMIZATION_LEVELS:
+            raise ValueError(f"Unknown graph_optimization '{graph_optimization}', "
+                             f"expected one of {sorted(self.OPTIMIZATION_LEVELS)}")
+
+        self.model_path = model_path
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.graph_optimization = graph_optimization
+        self.parallel = parallel
+        self.providers = list(providers)
+        self._open_session()
+
+    def _open_session(self):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = (_inference_threads if _inference_threads is not None
+                                        else self.intra_op_threads)
+        options.inter_op_num_threads = self.inter_op_threads
+        options.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel, self.OPTIMIZATION_LEVELS[self.graph_optimization])
+        options.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if self.parallel
+                                  else ort.ExecutionMode.ORT_SEQUENTIAL)
+
+        self.session = ort.InferenceSession(self.model_path, sess_options=options, providers=self.providers)
+        self._pid = os.getpid()
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # A symbolic or missing batch dimension means the graph accepts any batch size
+        self.fixed_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+
+    def forward(self, blob):
+        """
+        Runs the session over a batch blob, same contract as CvDnnBackend.forward.
+        """
+        if self._pid != os.getpid():
+            self._open_session()
+        blob = np.ascontiguousarray(blob, dtype=np.float32)
+        if self.fixed_batch in (None, len(blob)):
+            return self.session.run(None, {self.input_name: blob})[0]
+
+        outputs = [self.session.run(None, {self.input_name: blob[i:i + 1]})[0] for i in range(len(blob))]
+        return np.concatenate(outputs)
+
+
+# "fp32" is the exported model; quantize.py writes the others next to it as <name>.<variant>.onnx
+MODEL_VARIANTS = ("fp32", "fp16", "int8-dynamic", "int8-static")
+
+def variant_path(weights, variant="fp32"):
+    """
+    Path of a model variant, e.g. yoloResources/holes.int8-static.onnx for holes.onnx.
+    """
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant '{variant}', expected one of {list(MODEL_VARIANTS)}")
+    if variant == "fp32":
+        return weights
+    root, extension = os.path.splitext(weights)
+    return f"{root}.{variant}{extension}"
+
+def model_version(model_path):
+    """
+    Short content hash of a weights file, so results can be tied to the exact model that produced them.
+    """
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as model_file:
+        for chunk in iter(lambda: model_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+BACKENDS = {
+    CvDnnBackend.name: CvDnnBackend,
+    OnnxRuntimeBackend.name: OnnxRuntimeBackend,
+}
+
+def load_backend(model_path, backend="cv2", **options):
+    """
+    Creates an inference backend for an ONNX model.
+
+    Args:
+        model_path (str): Path to the ONNX weights.
+        backend (str): Name of a backend in BACKENDS.
+        **options: Backend specific settings, e.g. threads or graph_optimization.
+
+    Returns:
+        An object with a forward(blob) method returning (N, 4 + num_classes, num_anchors) outputs.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[backend](model_path, **options)
+
+
+class ModelPool:
+    """
+    Keeps several independent backend instances of one model.
+
+    OpenCV nets keep their input as state between setInput and forward, so one
+    instance must never serve two requests at once. Each forward checks out a free
+    instance, blocking until one is returned if all are busy.
+
+    Args:
+        model_path (str): Path to the ONNX weights.
+        backend (str): Name of a backend in BACKENDS.
+        instances (int): Number of independent instances to load.
+        **options: Backend specific settings passed to every instance.
+    """
+
+    def __init__(self, model_path, backend="cv2", instances=1, **options):
+        if instances < 1:
+            raise ValueError("A model pool needs at least one instance")
+        self.model_path = model_path
+        self.backend = backend
+        self.size = instances
+        self.version = model_version(model_path)
+        self.instances = [load_backend(model_path, backend, **options) for _ in range(instances)]
+        # LIFO hands out the most recently used instance, whose buffers are still warm
+        self._available = queue.LifoQueue()
+        for instance in self.instances:
+            self._available.put(instance)
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """
+        Borrows an instance for the duration of a with block.
+
+        Args:
+            timeout (float): Seconds to wait for a free instance, None waits forever.
+        """
+        instance = self._available.get(timeout=timeout)
+        try:
+            yield instance
+        finally:
+            self._available.put(instance)
+
+    def forward(self, blob):
+        """
+        Runs a batch blob on a free instance, same contract as the backends' forward.
+        """
+        with self.checkout() as instance:
+            return instance.forward(blob)
+
+    def warm_up(self, blob):
+        """
+        Runs one forward on every instance so graph allocation happens before real traffic.
+        """
+        for instance in self.instances:
+            instance.forward(blob)
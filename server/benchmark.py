@@ -0,0 +1,263 @@
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import time
+
+# The full-route benchmark must never call Gemini or reload models mid-run
+os.environ.setdefault("GOODTOGO_LLM_CLIENT", "stub")
+os.environ.setdefault("GOODTOGO_MODEL_WATCH_INTERVAL", "0")
+# Timed requests must run detection and the prompts, not read earlier results back from the cache
+os.environ["GOODTOGO_CACHE_ENTRIES"] = "0"
+os.environ.pop("GOODTOGO_CACHE_DIR", None)
+
+import cv2
+import numpy as np
+
+SAMPLE_IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mac-yolo")
+SAMPLE_USER = {
+    "ip": "45.134.56.7",
+    "amountReturned": 10,
+    "amountBought": 200,
+    "productsBought": 5,
+    "productsReturned": 1,
+    "numFailedAttempts": 0,
+}
+
+
+def summarize(latencies, items_per_call=1):
+    """
+    Turns per-call latencies in seconds into throughput and percentile figures.
+    """
+    latencies = np.asarray(latencies)
+    total = latencies.sum()
+    return {
+        "calls": len(latencies),
+        "throughput_per_s": round(len(latencies) * items_per_call / total, 3) if total > 0 else None,
+        "mean_ms": round(latencies.mean() * 1000, 3),
+        "p50_ms": round(np.percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(np.percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(np.percentile(latencies, 99) * 1000, 3),
+    }
+
+def measure(fn, iterations, warmup=1, items_per_call=1):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies, items_per_call)
+
+def sample_images():
+    """
+    Loads the photos in mac-yolo/ as (name, encoded bytes, decoded image).
+    """
+    images = []
+    for path in sorted(glob.glob(os.path.join(SAMPLE_IMAGE_DIR, "*"))):
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        ok, buffer = cv2.imencode(".jpg", image)
+        images.append((os.path.basename(path), buffer.tobytes(), image))
+    return images
+
+def synthetic_image(width, height, seed=0):
+    """
+    Textured noise with a few blobs, so detectors and JPEG see something photo-like.
+    """
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, size=(max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(5):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, center, int(rng.integers(5, max(6, min(width, height) // 10))), (40, 40, 40), -1)
+    return image
+
+# Flips and rotations give every iteration perceptually different copies of the sample photos
+ORIENTATIONS = (None, 1, 0, -1)
+ROTATIONS = (None, cv2.ROTATE_90_CLOCKWISE)
+
+def photo_variant(image, iteration):
+    """
+    Encodes a copy of image that is different for every iteration, in bytes and in perceptual hash.
+    """
+    flip = ORIENTATIONS[iteration % len(ORIENTATIONS)]
+    rotation = ROTATIONS[(iteration // len(ORIENTATIONS)) % len(ROTATIONS)]
+    variant = image if flip is None else cv2.flip(image, flip)
+    variant = variant if rotation is None else cv2.rotate(variant, rotation)
+    variant = variant.copy()
+    # Past the eight orientations the bytes still differ, so the result cache could never answer
+    variant[0, 0] = (iteration % 256, iteration // 256 % 256, 0)
+    return cv2.imencode(".jpg", variant)[1].tobytes()
+
+def bench_detection(models, sizes, batch_sizes, iterations):
+    from yolo import detect_images
+
+    results = []
+    for size in sizes:
+        width, height = size
+        image = synthetic_image(width, height)
+        for batch_size in batch_sizes:
+            images = [image] * batch_size
+            for model_name, model in models.items():
+                stats = measure(lambda: detect_images({model_name: model}, images), iterations,
+                                items_per_call=batch_size)
+                results.append({"model": model_name, "width": width, "height": height,
+                                "batch_size": batch_size, **stats})
+                print(f"detect {model_name} {width}x{height} batch {batch_size}: "
+                      f"p50 {stats['p50_ms']}ms, {stats['throughput_per_s']} img/s")
+    return results
+
+def bench_wardrobing(iterations, bulk_size):
+    import wardrobing
+
+    wardrobing.load_model()
+    rng = np.random.default_rng(0)
+    records = [
+        dict(SAMPLE_USER, ip=wardrobing.random_ip(), amountReturned=float(rng.uniform(5, 2000)),
+             numFailedAttempts=int(rng.integers(0, 6)))
+        for _ in range(bulk_size)
+    ]
+
+    results = {
+        "preprocess_user_data": measure(lambda: wardrobing.preprocess_user_data(SAMPLE_USER), iterations),
+        "is_wardrobe": measure(lambda: wardrobing.is_wardrobe(SAMPLE_USER), iterations),
+        "preprocess_users_bulk": measure(lambda: wardrobing.preprocess_users(records), max(3, iterations // 10),
+                                         items_per_call=bulk_size),
+        "score_users_bulk": measure(lambda: wardrobing.score_users(records), max(3, iterations // 10),
+                                    items_per_call=bulk_size),
+    }
+    for name, stats in results.items():
+        print(f"{name}: p50 {stats['p50_ms']}ms, {stats['throughput_per_s']}/s")
+    return results
+
+def bench_route(app, photo_sets, iterations, warmup=1):
+    """
+    Times POST /api/data end to end.
+
+    Args:
+        photo_sets (dict): Set name to make_photos(iteration), returning the photos of one request.
+            Every call should return different photos so no request is answered from the cache
+            or collapsed as a duplicate.
+    """
+    client = app.test_client()
+    results = []
+    for name, make_photos in photo_sets.items():
+        # Encoded before timing starts, one distinct set per call
+        requests = iter([make_photos(iteration) for iteration in range(warmup + iterations)])
+        count = 0
+
+        def post():
+            nonlocal count
+            photos = next(requests)
+            count = len(photos)
+            data = {
+                "price": "100",
+                "userData": json.dumps(SAMPLE_USER),
+                "photos": [(io.BytesIO(photo), f"photo_{index}.jpg") for index, photo in enumerate(photos)],
+            }
+            response = client.post("/api/data", data=data, content_type="multipart/form-data")
+            if response.status_code != 200:
+                raise RuntimeError(f"/api/data returned {response.status_code}: {response.get_data(as_text=True)}")
+
+        stats = measure(post, iterations, warmup)
+        results.append({"photos": name, "count": count, **stats})
+        print(f"/api/data {name} ({count} photos): p50 {stats['p50_ms']}ms")
+    return results
+
+def compare(current, baseline, threshold):
+    """
+    Lists p50 latencies that got more than threshold (a fraction) slower than the baseline run.
+    """
+    def flatten(results, prefix=""):
+        if isinstance(results, dict) and "p50_ms" in results:
+            yield prefix, results["p50_ms"]
+        elif isinstance(results, dict):
+            for key, value in results.items():
+                yield from flatten(value, f"{prefix}/{key}" if prefix else key)
+        elif isinstance(results, list):
+            for entry in results:
+                label = ",".join(f"{key}={value}" for key, value in entry.items()
+                                 if key in ("model", "width", "height", "batch_size", "photos"))
+                yield f"{prefix}[{label}]", entry["p50_ms"]
+
+    baseline_p50 = dict(flatten(baseline["results"]))
+    regressions = []
+    for name, p50 in flatten(current["results"]):
+        before = baseline_p50.get(name)
+        if before and p50 > before * (1 + threshold):
+            regressions.append({"benchmark": name, "baseline_p50_ms": before, "p50_ms": p50,
+                                "change": round(p50 / before - 1, 3)})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the return-assessment pipeline.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to save the results.")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed calls per benchmark.")
+    parser.add_argument("--sizes", default="640x640,1280x960,4032x3024", help="Synthetic image sizes, WxH.")
+    parser.add_argument("--batch-sizes", default="1,5", help="Images per detect_images call.")
+    parser.add_argument("--bulk-size", type=int, default=10000, help="Users per bulk wardrobing call.")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["detection", "wardrobing", "route"],
+                        help="Benchmarks to leave out.")
+    parser.add_argument("--compare", help="Earlier results JSON to check for regressions.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown that counts as a regression.")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(value) for value in size.split("x")) for size in args.sizes.split(",")]
+    batch_sizes = [int(value) for value in args.batch_sizes.split(",")]
+
+    results = {}
+    if "detection" not in args.skip or "route" not in args.skip:
+        from flask import Flask
+        from routes import MODEL_PATHS, init_routes
+        from yolo import model_dict
+
+        app = Flask(__name__)
+        init_routes(app)
+        models = {name: model_dict[name] for name in MODEL_PATHS}
+
+    if "detection" not in args.skip:
+        results["detection"] = bench_detection(models, sizes, batch_sizes, args.iterations)
+    if "wardrobing" not in args.skip:
+        results["wardrobing"] = bench_wardrobing(args.iterations * 10, args.bulk_size)
+    if "route" not in args.skip:
+        photo_sets = {}
+        samples = [image for _, _, image in sample_images()[:5]]
+        if samples:
+            photo_sets["mac-yolo"] = lambda iteration: [photo_variant(image, iteration) for image in samples]
+        for width, height in sizes:
+            # Five different photos per request, never repeated across requests
+            photo_sets[f"synthetic-{width}x{height}"] = lambda iteration, width=width, height=height: [
+                cv2.imencode(".jpg", synthetic_image(width, height, seed=iteration * 5 + index))[1].tobytes()
+                for index in range(5)]
+        results["route"] = bench_route(app, photo_sets, max(3, args.iterations // 4))
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "results": results,
+    }
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            report["regressions"] = compare(report, json.load(baseline_file), args.threshold)
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['benchmark']}: {regression['baseline_p50_ms']}ms -> "
+                  f"{regression['p50_ms']}ms (+{regression['change'] * 100:.1f}%)")
+
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"Saved results to {args.output}")
+
+    if report.get("regressions"):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
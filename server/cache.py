@@ -0,0 +1,182 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import log
+
+
+def make_key(*parts):
+    """
+    Hashes bytes, strings and numbers into a hex cache key.
+
+    Args:
+        *parts: Values that together identify a result, e.g. image bytes, model version and thresholds.
+
+    Returns:
+        str: SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            data = bytes(part)
+        else:
+            data = repr(part).encode("utf-8")
+        # Length prefix so ("ab", "c") and ("a", "bc") hash differently
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache for detection and assessment results.
+
+    Entries live in an in-memory LRU and, when disk_dir is set, are also pickled to
+    disk so they survive restarts and can be shared between worker processes.
+    Both tiers expire entries after ttl seconds and evict least recently used
+    entries once over their size limit.
+
+    Args:
+        max_entries (int): Entries kept in memory.
+        ttl (float): Seconds an entry stays valid, None to keep entries until evicted.
+        disk_dir (str): Folder for the on-disk tier, None to keep the cache in memory only.
+        max_disk_bytes (int): Size limit of the on-disk tier.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600, disk_dir=None, max_disk_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "memory_hits": 0, "disk_hits": 0, "evictions": 0}
+
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(os.path.getsize(path) for path in self._disk_files())
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".pkl")
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.endswith(".pkl"):
+                    yield os.path.join(root, name)
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            if self._expired(os.path.getmtime(path)):
+                self._remove_disk(path)
+                return None
+            with open(path, "rb") as file:
+                value = pickle.load(file)
+            os.utime(path)  # refresh for LRU eviction
+            return value
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _write_disk(self, key, value):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename so readers never see half a pickle
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temp_path, path)
+        self._disk_bytes += os.path.getsize(path) - previous
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict_disk()
+
+    def _remove_disk(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._disk_bytes -= size
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files(), key=os.path.getmtime)
+        for path in files:
+            if self._disk_bytes <= self.max_disk_bytes * 0.9:
+                break
+            self._remove_disk(path)
+            self._counters["evictions"] += 1
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default on a miss.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self._counters["hits"] += 1
+                self._counters["memory_hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self._memory[key]
+
+            if self.disk_dir:
+                value = self._read_disk(key)
+                if value is not None:
+                    self._store_memory(key, value)
+                    self._counters["hits"] += 1
+                    self._counters["disk_hits"] += 1
+                    return value
+
+            self._counters["misses"] += 1
+            return default
+
+    def _store_memory(self, key, value):
+        self._memory[key] = (time.time(), value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def set(self, key, value):
+        """
+        Stores value under key in both tiers.
+        """
+        with self._lock:
+            self._store_memory(key, value)
+            if self.disk_dir:
+                try:
+                    self._write_disk(key, value)
+                except OSError as e:
+                    log(f"Could not write cache entry to disk: {e}", level=logging.WARNING, error=str(e))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.disk_dir:
+                for path in list(self._disk_files()):
+                    self._remove_disk(path)
+
+    def stats(self):
+        """
+        Returns hit/miss counters and current sizes.
+        """
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+
+from sqlite_connection import SQLiteConnection
+
+# Running totals kept per customer, mapped to the userData fields the wardrobing model reads
+FEATURE_FIELDS = {
+    "products_bought": "productsBought",
+    "amount_bought": "amountBought",
+    "products_returned": "productsReturned",
+    "amount_returned": "amountReturned",
+    "num_failed_attempts": "numFailedAttempts",
+}
+EVENT_TYPES = ("purchase", "return", "failed_attempt")
+
+
+def customer_id(user_data):
+    """
+    Identifies the customer in userData by customerId, falling back to their email.
+    """
+    value = user_data.get("customerId") or user_data.get("email")
+    return str(value) if value is not None else None
+
+
+class CustomerFeatureStore:
+    """
+    Per-customer purchase and return aggregates, updated as order events arrive.
+
+    Every event is one upsert that adds to the customer's running totals, so an
+    update costs the same however long their history is. The wardrobing check reads
+    the totals with a primary-key lookup instead of trusting the aggregates the app
+    sends in userData or recomputing them from order history.
+
+    Args:
+        path (str): SQLite database file; ":memory:" keeps the features for this process only.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = SQLiteConnection(path, self._create_tables)
+
+    @staticmethod
+    def _create_tables(connection):
+        columns = ", ".join(f"{column} REAL NOT NULL DEFAULT 0" for column in FEATURE_FIELDS)
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS customer_features (customer_id TEXT PRIMARY KEY, {columns}, "
+            f"payment_method TEXT, ip TEXT, updated_at REAL NOT NULL)")
+
+    def _row(self, event):
+        customer = customer_id(event)
+        if customer is None:
+            raise ValueError("Event has no customerId")
+        event_type = event.get("type")
+        if event_type not in EVENT_TYPES:
+            raise ValueError(f"Unknown event type '{event_type}', expected one of {list(EVENT_TYPES)}")
+
+        amount = float(event.get("amount", 0))
+        quantity = float(event.get("quantity", 1))
+        increments = dict.fromkeys(FEATURE_FIELDS, 0.0)
+        if event_type == "purchase":
+            increments["products_bought"] = quantity
+            increments["amount_bought"] = amount
+        elif event_type == "return":
+            increments["products_returned"] = quantity
+            increments["amount_returned"] = amount
+        else:
+            increments["num_failed_attempts"] = 1.0
+        return (customer, *increments.values(), event.get("paymentMethod"), event.get("ip"), time.time())
+
+    def record(self, event):
+        """
+        Adds one order event to its customer's totals.
+
+        Args:
+            event (dict): {"type": "purchase" | "return" | "failed_attempt", "customerId", and optionally
+                "amount", "quantity" (default 1), "paymentMethod" and "ip"}. Purchases add to the bought
+                totals, returns to the returned totals; failed attempts count payment failures.
+
+        Raises:
+            ValueError: If the event has no customer or an unknown type.
+        """
+        self.record_many([event])
+
+    def record_many(self, events):
+        """
+        Records a list of events in one transaction and returns how many were recorded.
+
+        Nothing is recorded if any event is invalid.
+        """
+        rows = [self._row(event) for event in events]
+        columns = ", ".join(FEATURE_FIELDS)
+        placeholders = ", ".join("?" * (len(FEATURE_FIELDS) + 4))
+        updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in FEATURE_FIELDS)
+        with self._lock:
+            connection = self._db.get()
+            connection.executemany(
+                f"INSERT INTO customer_features (customer_id, {columns}, payment_method, ip, updated_at) "
+                f"VALUES ({placeholders}) ON CONFLICT (customer_id) DO UPDATE SET {updates}, "
+                f"payment_method = COALESCE(excluded.payment_method, payment_method), "
+                f"ip = COALESCE(excluded.ip, ip), updated_at = excluded.updated_at",
+                rows)
+            connection.commit()
+        return len(rows)
+
+    def features(self, customer):
+        """
+        Current totals of a customer as userData fields, or None if no event has been recorded for them.
+        """
+        columns = ", ".join(FEATURE_FIELDS)
+        with self._lock:
+            row = self._db.get().execute(
+                f"SELECT {columns}, payment_method, ip FROM customer_features WHERE customer_id = ?",
+                (customer,)).fetchone()
+        if row is None:
+            return None
+        features = dict(zip(FEATURE_FIELDS.values(), row))
+        if row[-2] is not None:
+            features["payment_method"] = row[-2]
+        if row[-1] is not None:
+            features["lastIp"] = row[-1]
+        return features
+
+    def merge(self, user_data):
+        """
+        Returns userData with its aggregates replaced by the stored ones for the same customer.
+
+        Customers without recorded events keep the values they sent.
+        """
+        customer = customer_id(user_data)
+        features = self.features(customer) if customer is not None else None
+        if features is None:
+            return user_data
+        features.pop("lastIp", None)
+        return {**user_data, **features}
+
+    def __len__(self):
+        with self._lock:
+            return self._db.get().execute("SELECT COUNT(*) FROM customer_features").fetchone()[0]
+
+
+def open_feature_store():
+    """
+    Opens the store at GOODTOGO_FEATURE_STORE, or an in-memory one when it is not set.
+    """
+    return CustomerFeatureStore(os.environ.get("GOODTOGO_FEATURE_STORE", ":memory:"))
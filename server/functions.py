@@ -1,109 +1,321 @@
-import google.generativeai as genai
-import pathlib
+import contextvars
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
 import PIL.Image
 
-# Set up Gemini API Key (configure it correctly)
-def condition_grading(price="100"):
-    try:
-        # Open the images
-        pil_image1 = PIL.Image.open("uploads/photo_1.jpg")
-        pil_image2 = PIL.Image.open("uploads/photo_2.jpg")
-        pil_image3 = PIL.Image.open("uploads/photo_3.jpg")
-        pil_image4 = PIL.Image.open("uploads/photo_4.jpg")
-        pil_image5 = PIL.Image.open("uploads/photo_5.jpg")
+from cache import make_key
+from metrics import timed
 
-        # Configure the Gemini API with your key
-        genai.configure(api_key="")
+try:
+    import google.generativeai as genai
+except ImportError:  # only needed by GeminiClient, the stub client works without it
+    genai = None
 
-        # Define the prompt
-        prompt = (
-            f"Analyze the following images and assess their physical condition based on visible wear, damage, or missing parts. "
-            f"Classify the product as a whole into one of the following categories: Salvage, Fair, Used - Good, or Used - Like New. "
-            f"Justify your classification based on the visible features across all images.\n\n"
-            f"Additionally, estimate the current market value of the product, considering an original price of {price}.\n\n"
-            f"Return your assessment for the product like the following example, NOTHING MORE NOTHING LESS: "
-            f"Used - Like New,99"
-        )
+GEMINI_MODEL = "gemini-1.5-flash"
+UPLOAD_PHOTOS = [f"uploads/photo_{index}.jpg" for index in range(1, 6)]
+ASSESSMENT_KINDS = ("grading_result", "recommended_action", "recommended_repair")
 
-        # Initialize the model
-        model = genai.GenerativeModel("gemini-1.5-flash")
+ERROR_MESSAGES = {
+    "grading_result": "Error: Unable to grade the images. Details: {}",
+    "recommended_action": "Error: Unable to recommend an action for the images. Details: {}",
+    "recommended_repair": "Error: Unable to recommend a repair action for the images. Details: {}",
+}
 
-        # Generate the response
-        response = model.generate_content([prompt, pil_image1, pil_image2, pil_image3, pil_image4, pil_image5])
+def grading_prompt(price="100"):
+    return (
+        f"Analyze the following images and assess their physical condition based on visible wear, damage, or missing parts. "
+        f"Classify the product as a whole into one of the following categories: Salvage, Fair, Used - Good, or Used - Like New. "
+        f"Justify your classification based on the visible features across all images.\n\n"
+        f"Additionally, estimate the current market value of the product, considering an original price of {price}.\n\n"
+        f"Return your assessment for the product like the following example, NOTHING MORE NOTHING LESS: "
+        f"Used - Like New,99"
+    )
 
-        # Print and return the response
-        return response.text.strip()  # Return the response text
+def action_prompt(price="100"):
+    return (
+        f"Analyze the following images and assess their physical condition based on visible wear, damage, or missing parts. "
+        f"Estimate the current market value of the product, considering an original price of {price} for the following options:\n"
+        f"- Resell to online platform (if value is 70% or more of the original price)\n"
+        f"- Auction to marketplace (if value is between 50% and 70% of the original price)\n"
+        f"- Go to SALE section (if value is between 10% and 50% of the original price)\n"
+        f"- Send to recycle (if product looks recyclable and value is between 0% and 50%)\n\n"
+        f"- Send to landfill (if value is 0 to 10%)\n\n"
+        f"Return a string with the actions and their corresponding estimated values in the following format, NOTHING MORE NOTHING LESS:\n"
+        f"1,<estimated_value>|2,<estimated_value>|3,<estimated_value>|4,<estimated_value>|5,<estimated_value>"
+    )
 
-    except Exception as e:
-        return f"Error: Unable to grade the images. Details: {str(e)}"
+def repair_prompt():
+    return (
+        f"Analyze the following images and identify if repair is needed and if so, the repair actions needed to restore the product to a functional state. "
+        f"Mention the repair actions in the order they should be performed, based on the visible issues in the images.\n\n"
+        f"Return your recommended repair actions in the following format, NOTHING MORE NOTHING LESS:\n"
+        f"YES,<your explanation>\n OR"
+        f"NO,<your explanation>\n"
+    )
 
-def recommended_action(price="100"):
-    try:
-        # Open the images
-        pil_image1 = PIL.Image.open("uploads/photo_1.jpg")
-        pil_image2 = PIL.Image.open("uploads/photo_2.jpg")
-        pil_image3 = PIL.Image.open("uploads/photo_3.jpg")
-        pil_image4 = PIL.Image.open("uploads/photo_4.jpg")
-        pil_image5 = PIL.Image.open("uploads/photo_5.jpg")
+def combined_prompt(price="100"):
+    return (
+        f"Analyze the following images of a returned product and answer three questions about it.\n\n"
+        f"grading_result: {grading_prompt(price)}\n\n"
+        f"recommended_action: {action_prompt(price)}\n\n"
+        f"recommended_repair: {repair_prompt()}\n\n"
+        f"Return a JSON object with exactly the keys grading_result, recommended_action and recommended_repair, "
+        f"each holding a string in the format requested for that question."
+    )
+
+def load_images(paths=UPLOAD_PHOTOS):
+    """
+    Opens the photos once so every prompt can share them.
+    """
+    images = []
+    for path in paths:
+        image = PIL.Image.open(path)
+        image.load()  # decode now, PIL's lazy loading is not safe across threads
+        images.append(image)
+    return images
+
+def images_from_bytes(datas, max_side=None):
+    """
+    Decodes uploaded photo bytes straight into PIL images, without touching the disk.
+
+    With max_side set, JPEGs are decoded at the coarsest scale that keeps both sides
+    at least that large, instead of at full resolution.
+    """
+    images = []
+    for data in datas:
+        image = PIL.Image.open(io.BytesIO(data))
+        if max_side:
+            image.draft("RGB", (max_side, max_side))
+        image.load()
+        images.append(image)
+    return images
+
+
+class GeminiClient:
+    """
+    Sends prompts and images to Gemini.
+    """
 
+    def __init__(self, model_name=GEMINI_MODEL, api_key=None):
+        if genai is None:
+            raise ImportError("google-generativeai is not installed; pip install google-generativeai")
         # Configure the Gemini API with your key
-        genai.configure(api_key="")
+        genai.configure(api_key=api_key if api_key is not None else os.environ.get("GEMINI_API_KEY", ""))
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name)
 
-        prompt = (
-            f"Analyze the following images and assess their physical condition based on visible wear, damage, or missing parts. "
-            f"Estimate the current market value of the product, considering an original price of {price} for the following options:\n"
-            f"- Resell to online platform (if value is 70% or more of the original price)\n"
-            f"- Auction to marketplace (if value is between 50% and 70% of the original price)\n"
-            f"- Go to SALE section (if value is between 10% and 50% of the original price)\n"
-            f"- Send to recycle (if product looks recyclable and value is between 0% and 50%)\n\n"
-            f"- Send to landfill (if value is 0 to 10%)\n\n"
-            f"Return a string with the actions and their corresponding estimated values in the following format, NOTHING MORE NOTHING LESS:\n"
-            f"1,<estimated_value>|2,<estimated_value>|3,<estimated_value>|4,<estimated_value>|5,<estimated_value>"
-        )
+    def generate(self, prompt, images, json_output=False, kind=None):
+        generation_config = {"response_mime_type": "application/json"} if json_output else None
+        response = self.model.generate_content([prompt, *images], generation_config=generation_config)
+        return response.text.strip()
 
-        # Initialize the model
-        model = genai.GenerativeModel("gemini-1.5-flash")
 
-        # Generate the response
-        response = model.generate_content([prompt, pil_image1, pil_image2, pil_image3, pil_image4, pil_image5])
+class StubClient:
+    """
+    Offline stand-in for GeminiClient that returns canned answers, for tests and benchmarks.
 
-        # Print and return the response
-        return response.text.strip()  # Return the response text
+    Args:
+        responses (dict): Answer per assessment kind, overriding the defaults.
+        delay (float): Seconds to sleep per call, to mimic remote latency.
+    """
 
-    except Exception as e:
-        return f"Error: Unable to recommend an action for the images. Details: {str(e)}"
-    
-def recommended_repair():
-    try:
-        # Open the images
-        pil_image1 = PIL.Image.open("uploads/photo_1.jpg")
-        pil_image2 = PIL.Image.open("uploads/photo_2.jpg")
-        pil_image3 = PIL.Image.open("uploads/photo_3.jpg")
-        pil_image4 = PIL.Image.open("uploads/photo_4.jpg")
-        pil_image5 = PIL.Image.open("uploads/photo_5.jpg")
+    DEFAULT_RESPONSES = {
+        "grading_result": "Used - Good,70",
+        "recommended_action": "1,70|2,60|3,40|4,20|5,5",
+        "recommended_repair": "NO,No visible damage that needs repair.",
+    }
 
-        # Configure the Gemini API with your key
-        genai.configure(api_key="")
+    def __init__(self, responses=None, delay=0.0):
+        self.responses = {**self.DEFAULT_RESPONSES, **(responses or {})}
+        self.delay = delay
+        self.calls = 0
+
+    def generate(self, prompt, images, json_output=False, kind=None):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if json_output:
+            return json.dumps(self.responses)
+        return self.responses[kind]
+
+
+def make_client(name=None):
+    """
+    Builds the LLM client named by name or the GOODTOGO_LLM_CLIENT variable ("gemini" or "stub").
+    """
+    name = name or os.environ.get("GOODTOGO_LLM_CLIENT", "gemini")
+    if name == "stub":
+        return StubClient()
+    return GeminiClient()
+
+
+class AssessmentEngine:
+    """
+    Runs the grading, action and repair prompts for one return.
+
+    Each prompt is sent once and the three run concurrently; anything still pending
+    when the time budget runs out is reported as an error instead of holding the
+    request. With combined=True the three questions go out as one JSON call.
+
+    Args:
+        client: Object with generate(prompt, images, json_output, kind), e.g. GeminiClient or StubClient.
+        timeout (float): Time budget in seconds for the whole assessment.
+        combined (bool): Ask all three questions in a single structured-output call.
+        max_workers (int): Threads available for concurrent prompts across requests.
+        cache (ResultCache): Optional cache of answers keyed by photos, prompt and price.
+    """
+
+    def __init__(self, client=None, timeout=30.0, combined=False, max_workers=6, cache=None):
+        self.client = client if client is not None else make_client()
+        self.timeout = timeout
+        self.combined = combined
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="assessment")
 
-        prompt = (
-            f"Analyze the following images and identify if repair is needed and if so, the repair actions needed to restore the product to a functional state. "
-            f"Mention the repair actions in the order they should be performed, based on the visible issues in the images.\n\n"
-            f"Return your recommended repair actions in the following format, NOTHING MORE NOTHING LESS:\n"
-            f"YES,<your explanation>\n OR"
-            f"NO,<your explanation>\n"
-        )
+    def _prompts(self, price):
+        return {
+            "grading_result": grading_prompt(price),
+            "recommended_action": action_prompt(price),
+            "recommended_repair": repair_prompt(),
+        }
 
-        # Initialize the model
-        model = genai.GenerativeModel("gemini-1.5-flash")
+    def _generate(self, kind, prompt, images):
+        try:
+            with timed("llm", kind):
+                return self.client.generate(prompt, images, kind=kind)
+        except Exception as e:
+            return ERROR_MESSAGES[kind].format(str(e))
 
-        # Generate the response
-        response = model.generate_content([prompt, pil_image1, pil_image2, pil_image3, pil_image4, pil_image5])
+    def _generate_combined(self, price, images):
+        try:
+            with timed("llm", "combined"):
+                answer = json.loads(self.client.generate(combined_prompt(price), images, json_output=True))
+        except Exception as e:
+            return {kind: ERROR_MESSAGES[kind].format(str(e)) for kind in ASSESSMENT_KINDS}
+        return {
+            kind: str(answer[kind]).strip() if kind in answer
+            else ERROR_MESSAGES[kind].format("missing from the combined response")
+            for kind in ASSESSMENT_KINDS
+        }
 
-        # Print and return the response
-        return response.text.strip()  # Return the response text
+    def _cache_keys(self, images, price, kinds):
+        # Photos are hashed once and shared by the keys of every prompt
+        photos = make_key(*((image.mode, image.size, image.tobytes()) for image in images))
+        client = getattr(self.client, "model_name", type(self.client).__name__)
+        prompts = self._prompts(price)
+        return {
+            kind: make_key("assessment", client, kind, self.combined,
+                           combined_prompt(price) if self.combined else prompts[kind], photos)
+            for kind in kinds
+        }
 
+    def assess(self, images, price="100", kinds=ASSESSMENT_KINDS):
+        """
+        Assesses a return from its photos.
+
+        Args:
+            images (list): Photos as PIL images.
+            price (str): Original price of the product.
+            kinds (tuple[str]): Which of ASSESSMENT_KINDS to run.
+
+        Returns:
+            dict: Answer string per kind; failures and timeouts hold an "Error: ..." string.
+        """
+        results = dict(self.iter_assess(images, price, kinds))
+        return {kind: results[kind] for kind in kinds}
+
+    def iter_assess(self, images, price="100", kinds=ASSESSMENT_KINDS):
+        """
+        Starts the prompts immediately and returns an iterator of (kind, answer) pairs.
+
+        Answers come out in the order they complete, cached ones first. The time
+        budget starts counting when this is called, not when the iterator is read,
+        so other work can run while the prompts are in flight.
+
+        Args:
+            images (list): Photos as PIL images.
+            price (str): Original price of the product.
+            kinds (tuple[str]): Which of ASSESSMENT_KINDS to run.
+        """
+        deadline = time.monotonic() + self.timeout
+
+        keys = self._cache_keys(images, price, kinds) if self.cache is not None else {}
+        cached = {}
+        for kind, key in keys.items():
+            answer = self.cache.get(key)
+            if answer is not None:
+                cached[kind] = answer
+
+        missing = tuple(kind for kind in kinds if kind not in cached)
+        futures = {}
+        # Each call runs in a copy of the caller's context, so its timing lands in the caller's breakdown
+        if missing and self.combined:
+            futures[self.executor.submit(contextvars.copy_context().run, self._generate_combined, price,
+                                         images)] = missing
+        elif missing:
+            prompts = self._prompts(price)
+            for kind in missing:
+                futures[self.executor.submit(contextvars.copy_context().run, self._generate, kind, prompts[kind],
+                                             images)] = (kind,)
+
+        return self._collect(cached, futures, deadline, keys)
+
+    def _collect(self, cached, futures, deadline, keys):
+        yield from cached.items()
+
+        finished = set()
+        try:
+            for future in as_completed(futures, timeout=max(deadline - time.monotonic(), 0)):
+                finished.add(future)
+                kinds = futures[future]
+                result = future.result()
+                answers = result if isinstance(result, dict) else {kinds[0]: result}
+                for kind in kinds:
+                    # Errors and timeouts are worth retrying, so only real answers are kept
+                    if kind in keys and not answers[kind].startswith("Error:"):
+                        self.cache.set(keys[kind], answers[kind])
+                    yield kind, answers[kind]
+        except FuturesTimeoutError:
+            for future, kinds in futures.items():
+                if future not in finished:
+                    future.cancel()
+                    for kind in kinds:
+                        yield kind, ERROR_MESSAGES[kind].format(f"timed out after {self.timeout}s")
+
+
+_default_engine = None
+
+def get_engine():
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = AssessmentEngine()
+    return _default_engine
+
+def condition_grading(price="100"):
+    try:
+        images = load_images()
+    except Exception as e:
+        return ERROR_MESSAGES["grading_result"].format(str(e))
+    return get_engine().assess(images, price, kinds=("grading_result",))["grading_result"]
+
+def recommended_action(price="100"):
+    try:
+        images = load_images()
+    except Exception as e:
+        return ERROR_MESSAGES["recommended_action"].format(str(e))
+    return get_engine().assess(images, price, kinds=("recommended_action",))["recommended_action"]
+
+def recommended_repair():
+    try:
+        images = load_images()
     except Exception as e:
-        return f"Error: Unable to recommend a repair action for the images. Details: {str(e)}"
+        return ERROR_MESSAGES["recommended_repair"].format(str(e))
+    return get_engine().assess(images, kinds=("recommended_repair",))["recommended_repair"]
 
 # def receipt_ocr():
 #     """Detects text in the file."""
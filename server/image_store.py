@@ -0,0 +1,85 @@
+import base64
+import hashlib
+
+import cv2
+
+from cache import ResultCache
+
+
+class AnnotatedImageStore:
+    """
+    Keeps encoded annotated photos so clients fetch them by URL instead of inline base64.
+
+    Each photo is encoded once at full size and once per thumbnail size, and stored
+    under the hash of its full-size JPEG, so the same image always gets the same URL
+    and ETag. Storage is a ResultCache, so entries expire after ttl seconds and the
+    least recently used ones are dropped once max_entries is reached.
+
+    Args:
+        quality (int): JPEG quality for the full-size image.
+        thumbnail_sizes (tuple[int]): Longest side of each thumbnail served.
+        preview_size (int): Thumbnail size inlined in the JSON response, one of thumbnail_sizes.
+        thumbnail_quality (int): JPEG quality for thumbnails.
+        max_entries (int): Encoded images kept in memory (each size counts once).
+        ttl (float): Seconds an image stays available.
+        disk_dir (str): Optional folder to also keep images on disk.
+    """
+
+    def __init__(self, quality=90, thumbnail_sizes=(160, 480), preview_size=480, thumbnail_quality=80,
+                 max_entries=1024, ttl=24 * 3600, disk_dir=None):
+        if preview_size not in thumbnail_sizes:
+            raise ValueError(f"preview_size {preview_size} must be one of thumbnail_sizes {thumbnail_sizes}")
+        self.quality = quality
+        self.thumbnail_sizes = tuple(thumbnail_sizes)
+        self.preview_size = preview_size
+        self.thumbnail_quality = thumbnail_quality
+        self._images = ResultCache(max_entries=max_entries, ttl=ttl, disk_dir=disk_dir)
+
+    @staticmethod
+    def _encode(image, quality):
+        ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("Could not encode annotated photo")
+        return buffer.tobytes()
+
+    def put(self, image):
+        """
+        Encodes and stores an annotated photo and its thumbnails.
+
+        Args:
+            image (numpy.ndarray): Annotated BGR image.
+
+        Returns:
+            dict: The image ID, its URL and thumbnail URLs, its size and a base64 preview.
+        """
+        full = self._encode(image, self.quality)
+        image_id = hashlib.sha256(full).hexdigest()[:32]
+        self._images.set(image_id, full)
+
+        [height, width, _] = image.shape
+        thumbnails = {}
+        preview = None
+        for size in self.thumbnail_sizes:
+            ratio = min(1.0, size / max(height, width))
+            thumbnail = cv2.resize(image, (max(1, round(width * ratio)), max(1, round(height * ratio))),
+                                   interpolation=cv2.INTER_AREA)
+            encoded = self._encode(thumbnail, self.thumbnail_quality)
+            self._images.set(f"{image_id}:{size}", encoded)
+            thumbnails[str(size)] = f"/api/images/{image_id}?size={size}"
+            if size == self.preview_size:
+                preview = base64.b64encode(encoded).decode("utf-8")
+
+        return {
+            "id": image_id,
+            "url": f"/api/images/{image_id}",
+            "thumbnails": thumbnails,
+            "width": width,
+            "height": height,
+            "preview": preview,
+        }
+
+    def get(self, image_id, size=None):
+        """
+        Returns the JPEG bytes of an image or one of its thumbnails, or None if unknown or expired.
+        """
+        return self._images.get(image_id if size is None else f"{image_id}:{size}")
@@ -0,0 +1,412 @@
+import argparse
+import json
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from metrics import log
+from yolo import (CONF_THRESHOLD, IOU_THRESHOLD, TOP_K, annotate_image, box_iou, class_dict, detect_images,
+                  detection_boxes)
+
+# Marks the end of the stream in the queues between stages
+_END = object()
+
+
+class Track:
+    """
+    One defect followed across frames.
+    """
+
+    def __init__(self, track_id, model_name, class_id, box, confidence, frame_index):
+        self.id = track_id
+        self.model_name = model_name
+        self.class_id = class_id
+        self.box = box
+        self.best_confidence = confidence
+        self.first_frame = frame_index
+        self.last_frame = frame_index
+        self.hits = 1
+        self.reported = False
+
+    def to_dict(self):
+        classes = class_dict.get(self.model_name, [])
+        # Class files list names by position; a names mapping is keyed by class id
+        if isinstance(classes, dict):
+            class_name = classes.get(self.class_id, str(self.class_id))
+        else:
+            class_name = classes[self.class_id] if 0 <= self.class_id < len(classes) else str(self.class_id)
+        return {
+            "track_id": self.id,
+            "model": self.model_name,
+            "class_id": self.class_id,
+            "class_name": class_name,
+            "confidence": round(self.best_confidence, 4),
+            "box": [round(float(value), 1) for value in self.box],
+            "first_frame": self.first_frame,
+            "last_frame": self.last_frame,
+            "hits": self.hits,
+        }
+
+
+class IoUTracker:
+    """
+    Greedy IoU box tracker, so a defect seen on many frames is reported once.
+
+    Detections are matched to the open tracks of the same model and class by
+    highest IoU. A track is reported once it has been seen on min_hits frames, which
+    also filters out one-frame flickers, and is closed after max_missed source frames
+    without a match.
+
+    Args:
+        iou_threshold (float): Minimum IoU for a detection to continue a track.
+        min_hits (int): Frames a defect must be seen on before it is reported.
+        max_missed (int): Source frames a track survives without a match.
+    """
+
+    def __init__(self, iou_threshold=0.3, min_hits=2, max_missed=15):
+        self.iou_threshold = iou_threshold
+        self.min_hits = min_hits
+        self.max_missed = max_missed
+        self.tracks = []
+        self.confirmed = 0
+        self._next_id = 1
+
+    def update(self, frame_index, detections):
+        """
+        Feeds one frame's detections to the tracker.
+
+        Args:
+            frame_index (int): Index of the frame in the source.
+            detections (dict): Model name to DETECTION_DTYPE array, as returned by detect_images.
+
+        Returns:
+            list[Track]: Tracks confirmed on this frame, i.e. newly found defects.
+        """
+        confirmed = []
+        for model_name, model_detections in detections.items():
+            for class_id in np.unique(model_detections["class_id"]):
+                class_detections = model_detections[model_detections["class_id"] == class_id]
+                confirmed.extend(self._match(frame_index, model_name, int(class_id), class_detections))
+
+        self.tracks = [track for track in self.tracks if frame_index - track.last_frame <= self.max_missed]
+        self.confirmed += len(confirmed)
+        return confirmed
+
+    def _match(self, frame_index, model_name, class_id, detections):
+        candidates = [track for track in self.tracks
+                      if track.model_name == model_name and track.class_id == class_id
+                      and track.last_frame < frame_index]
+        boxes = detection_boxes(detections)
+        unmatched = np.ones(len(detections), dtype=bool)
+        confirmed = []
+
+        if candidates:
+            iou = box_iou(np.array([track.box for track in candidates]), boxes)
+            # Highest-IoU pairs first; each track and detection is used at most once
+            for flat in np.argsort(-iou, axis=None):
+                t, d = np.unravel_index(flat, iou.shape)
+                if iou[t, d] < self.iou_threshold:
+                    break
+                track = candidates[t]
+                if not unmatched[d] or track.last_frame == frame_index:
+                    continue
+                unmatched[d] = False
+                track.box = boxes[d]
+                track.last_frame = frame_index
+                track.hits += 1
+                track.best_confidence = max(track.best_confidence, float(detections["confidence"][d]))
+                if not track.reported and track.hits >= self.min_hits:
+                    track.reported = True
+                    confirmed.append(track)
+
+        for d in np.flatnonzero(unmatched):
+            track = Track(self._next_id, model_name, class_id, boxes[d], float(detections["confidence"][d]),
+                          frame_index)
+            self._next_id += 1
+            self.tracks.append(track)
+            if self.min_hits <= 1:
+                track.reported = True
+                confirmed.append(track)
+        return confirmed
+
+
+class StreamInspector:
+    """
+    Inspects a video file, camera or iterable of frames with pipelined stages.
+
+    Decoding, inference and annotation each run on their own thread and hand frames
+    on through bounded queues, so the detector is never idle waiting for the decoder
+    and a slow stage only holds up a few frames. Inference takes whatever frames are
+    waiting, up to batch_size, and runs them in one forward.
+
+    Args:
+        models (dict): Model name to ModelPool, as filled in by add_model.
+        source: Video file path, camera index, or iterable of BGR frames.
+        frame_skip (int): Frames skipped after each inspected one; skipped frames are not decoded.
+        queue_size (int): Frames each queue holds before the stage feeding it waits.
+        batch_size (int): Most frames run through the detectors in one forward.
+        drop_frames (bool): When the decode queue is full, drop frames instead of waiting.
+            Defaults to True for cameras, which cannot be paused.
+        tracker (IoUTracker): Tracker deciding when a defect is new; a default one is used if None.
+        output_path (str): Optional video file the annotated frames are written to.
+        max_frames (int): Stop after this many source frames.
+    """
+
+    def __init__(self, models, source, frame_skip=0, queue_size=8, batch_size=4, drop_frames=None,
+                 tracker=None, output_path=None, max_frames=None, conf_threshold=CONF_THRESHOLD,
+                 iou_threshold=IOU_THRESHOLD, top_k=TOP_K):
+        self.models = models
+        self.source = source
+        self.frame_skip = frame_skip
+        self.batch_size = batch_size
+        self.drop_frames = isinstance(source, int) if drop_frames is None else drop_frames
+        self.tracker = tracker if tracker is not None else IoUTracker()
+        self.output_path = output_path
+        self.max_frames = max_frames
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.top_k = top_k
+
+        self._frames = queue.Queue(maxsize=queue_size)
+        self._detected = queue.Queue(maxsize=queue_size)
+        self._events = queue.Queue()
+        self._stop = threading.Event()
+        self._error = None
+        self.stats = {"frames_read": 0, "frames_skipped": 0, "frames_dropped": 0, "frames_inspected": 0,
+                      "batches": 0, "busy_seconds": {"decode": 0.0, "inference": 0.0, "annotation": 0.0}}
+        self._fps = 0.0
+
+    def _put(self, target, item):
+        # Waits for room, but gives up once the inspection is stopping
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _read_frames(self):
+        if isinstance(self.source, (str, int)):
+            capture = cv2.VideoCapture(self.source)
+            if not capture.isOpened():
+                raise ValueError(f"Could not open video source {self.source!r}")
+            self._fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+            try:
+                index = 0
+                while self.max_frames is None or index < self.max_frames:
+                    if index % (self.frame_skip + 1):
+                        # grab() advances without decoding the frame
+                        if not capture.grab():
+                            break
+                        self.stats["frames_skipped"] += 1
+                    else:
+                        ok, frame = capture.read()
+                        if not ok:
+                            break
+                        yield index, frame
+                    index += 1
+            finally:
+                capture.release()
+        else:
+            for index, frame in enumerate(self.source):
+                if self.max_frames is not None and index >= self.max_frames:
+                    break
+                if index % (self.frame_skip + 1):
+                    self.stats["frames_skipped"] += 1
+                    continue
+                yield index, frame
+
+    def _decode_stage(self):
+        try:
+            frames = self._read_frames()
+            while not self._stop.is_set():
+                started = time.perf_counter()
+                item = next(frames, None)
+                self.stats["busy_seconds"]["decode"] += time.perf_counter() - started
+                if item is None:
+                    break
+                self.stats["frames_read"] += 1
+                if self.drop_frames:
+                    try:
+                        self._frames.put_nowait(item)
+                    except queue.Full:
+                        self.stats["frames_dropped"] += 1
+                elif not self._put(self._frames, item):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self._frames, _END)
+
+    def _inference_stage(self):
+        try:
+            finished = False
+            while not finished and not self._stop.is_set():
+                try:
+                    item = self._frames.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _END:
+                    break
+                batch = [item]
+                # Frames already waiting share the forward, but never wait for a batch to fill
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._frames.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _END:
+                        finished = True
+                        break
+                    batch.append(item)
+
+                started = time.perf_counter()
+                detections = detect_images(self.models, [frame for _, frame in batch], self.conf_threshold,
+                                           self.iou_threshold, self.top_k)
+                self.stats["busy_seconds"]["inference"] += time.perf_counter() - started
+                self.stats["batches"] += 1
+                for (index, frame), frame_detections in zip(batch, detections):
+                    if not self._put(self._detected, (index, frame, frame_detections)):
+                        return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self._detected, _END)
+
+    def _annotation_stage(self):
+        writer = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = self._detected.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _END:
+                    break
+                index, frame, detections = item
+
+                started = time.perf_counter()
+                for track in self.tracker.update(index, detections):
+                    event = track.to_dict()
+                    event["timestamp"] = round(track.first_frame / self._fps, 3) if self._fps else None
+                    self._events.put(("defect", event))
+                if self.output_path:
+                    annotate_image(frame, detections)
+                    if writer is None:
+                        [height, width, _] = frame.shape
+                        fps = (self._fps or 30.0) / (self.frame_skip + 1)
+                        writer = cv2.VideoWriter(self.output_path, cv2.VideoWriter_fourcc(*"mp4v"), fps,
+                                                 (width, height))
+                    writer.write(frame)
+                self.stats["busy_seconds"]["annotation"] += time.perf_counter() - started
+                self.stats["frames_inspected"] += 1
+        except Exception as e:
+            self._fail(e)
+        finally:
+            if writer is not None:
+                writer.release()
+            self._events.put(_END)
+
+    def iter_events(self):
+        """
+        Runs the inspection and yields ("defect", track dict) as new defects are confirmed,
+        then ("report", report dict) once the stream ends.
+
+        Raises:
+            Exception: Whatever stopped one of the stages, after the others have shut down.
+        """
+        started = time.perf_counter()
+        threads = [threading.Thread(target=target, name=f"inspect-{name}", daemon=True)
+                   for name, target in (("decode", self._decode_stage), ("inference", self._inference_stage),
+                                        ("annotation", self._annotation_stage))]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                event = self._events.get()
+                if event is _END:
+                    break
+                yield event
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+        yield "report", self.report(time.perf_counter() - started)
+
+    def run(self):
+        """
+        Runs the inspection to the end.
+
+        Returns:
+            dict: The final report with a "defects" list of every confirmed defect.
+        """
+        defects = []
+        report = None
+        for kind, event in self.iter_events():
+            if kind == "defect":
+                defects.append(event)
+            else:
+                report = event
+        report["defects"] = defects
+        return report
+
+    def report(self, elapsed):
+        inspected = self.stats["frames_inspected"]
+        return {
+            **self.stats,
+            "busy_seconds": {stage: round(seconds, 3) for stage, seconds in self.stats["busy_seconds"].items()},
+            "elapsed_seconds": round(elapsed, 3),
+            # Inspected frames per wall-clock second, over the whole run
+            "sustained_fps": round(inspected / elapsed, 2) if elapsed > 0 else 0.0,
+            "source_fps": self._fps or None,
+            "defects_found": self.tracker.confirmed,
+        }
+
+
+if __name__ == "__main__":
+    from model_registry import ModelRegistry
+    from routes import MODEL_PATHS
+
+    parser = argparse.ArgumentParser(description="Inspect a video file or camera for defects.")
+    parser.add_argument("source", help="Video file path, or a camera index such as 0.")
+    parser.add_argument("--skip", type=int, default=0, help="Frames skipped after each inspected frame.")
+    parser.add_argument("--batch-size", type=int, default=4, help="Most frames per forward.")
+    parser.add_argument("--queue-size", type=int, default=8, help="Frames held between stages.")
+    parser.add_argument("--max-frames", type=int, help="Stop after this many source frames.")
+    parser.add_argument("--min-hits", type=int, default=2, help="Frames a defect must be seen on.")
+    parser.add_argument("--output", help="Write the annotated video here.")
+    parser.add_argument("--report", help="Write the JSON report here.")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(MODEL_PATHS)
+    registry.start()
+    source = int(args.source) if args.source.isdigit() else args.source
+    inspector = StreamInspector(registry.models(), source, frame_skip=args.skip, queue_size=args.queue_size,
+                                batch_size=args.batch_size, tracker=IoUTracker(min_hits=args.min_hits),
+                                output_path=args.output, max_frames=args.max_frames)
+
+    defects = []
+    for kind, event in inspector.iter_events():
+        if kind == "defect":
+            defects.append(event)
+            log(f"Defect {event['track_id']}: {event['class_name']} ({event['confidence']:.2f}) "
+                f"at frame {event['first_frame']}", **event)
+        else:
+            event["defects"] = defects
+            log(f"Inspected {event['frames_inspected']} of {event['frames_read'] + event['frames_skipped']} frames "
+                f"at {event['sustained_fps']} FPS, {len(defects)} defects", fps=event["sustained_fps"])
+            if args.report:
+                with open(args.report, "w") as report_file:
+                    json.dump(event, report_file, indent=2)
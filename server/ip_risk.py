@@ -0,0 +1,202 @@
+import bisect
+import ipaddress
+import os
+import socket
+import threading
+
+import numpy as np
+
+
+def _parse_entry(entry):
+    """
+    Turns a blocklist entry into an (ip version, first address, last address) interval.
+
+    Entries are CIDR blocks ("203.0.113.0/24"), single addresses, "start-end" ranges
+    or (start, end) tuples.
+    """
+    if isinstance(entry, (tuple, list)):
+        start, end = (ipaddress.ip_address(value) for value in entry)
+    elif "-" in entry:
+        start, end = (ipaddress.ip_address(value.strip()) for value in entry.split("-", 1))
+    else:
+        network = ipaddress.ip_network(entry.strip(), strict=False)
+        start, end = network.network_address, network.broadcast_address
+
+    if start.version != end.version:
+        raise ValueError(f"Range mixes IPv4 and IPv6: {entry}")
+    if int(start) > int(end):
+        start, end = end, start
+    return start.version, int(start), int(end)
+
+def _merge(intervals):
+    # Sorted, non-overlapping intervals let one binary search answer each lookup
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [start for start, _ in merged], [end for _, end in merged]
+
+def read_blocklist(path):
+    """
+    Reads blocklist entries from a file, one per line; blank lines and # comments are skipped.
+
+    Returns:
+        list[tuple]: (line number, entry) pairs.
+    """
+    entries = []
+    with open(path) as blocklist:
+        for number, line in enumerate(blocklist, 1):
+            line = line.split("#", 1)[0].strip()
+            if line:
+                entries.append((number, line))
+    return entries
+
+
+class IPRiskIndex:
+    """
+    High-risk IP lookup over sorted, merged address intervals.
+
+    IPv4 intervals are kept as NumPy arrays so whole columns of addresses can be
+    checked with one searchsorted call. IPv6 addresses do not fit in a NumPy integer,
+    so they use bisect over Python ints. Lookups cost O(log n) in the number of
+    ranges, which keeps threat-intel feeds of 100k+ CIDRs cheap.
+
+    Args:
+        entries (list): CIDR strings, single addresses, "start-end" strings or (start, end) tuples.
+        path (str): Optional blocklist file, read instead of entries and re-read by reload().
+    """
+
+    def __init__(self, entries=(), path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tables = None
+        if path:
+            self._load_file(path)
+        else:
+            self.load(entries)
+
+    def _load_file(self, path):
+        numbered = read_blocklist(path)
+        self.load([entry for _, entry in numbered], [number for number, _ in numbered])
+
+    def load(self, entries, line_numbers=None):
+        """
+        Replaces the index contents. Lookups running at the same time keep using the old tables.
+
+        Raises:
+            ValueError: Naming the line (or position) of the first invalid entry, but not its
+                contents, which may come from a file that should not be echoed back.
+        """
+        intervals = {4: [], 6: []}
+        for position, entry in enumerate(entries):
+            try:
+                version, start, end = _parse_entry(entry)
+            except ValueError:
+                where = f"line {line_numbers[position]}" if line_numbers else f"entry {position + 1}"
+                raise ValueError(f"Invalid blocklist entry on {where}") from None
+            intervals[version].append((start, end))
+
+        v4_starts, v4_ends = _merge(intervals[4])
+        v6_starts, v6_ends = _merge(intervals[6])
+        tables = (
+            np.array(v4_starts, dtype=np.int64),
+            np.array(v4_ends, dtype=np.int64),
+            v6_starts,
+            v6_ends,
+        )
+        # A single attribute swap, so readers never see half of an update
+        self._tables = tables
+
+    def reload(self):
+        """
+        Re-reads the blocklist file the index was built from without interrupting lookups.
+        """
+        with self._lock:
+            if self.path is None:
+                raise ValueError("No blocklist file to reload from")
+            self._load_file(self.path)
+
+    def __len__(self):
+        v4_starts, _, v6_starts, _ = self._tables
+        return len(v4_starts) + len(v6_starts)
+
+    def contains(self, ip):
+        """
+        Returns True if the address falls in a high-risk range.
+        """
+        v4_starts, v4_ends, v6_starts, v6_ends = self._tables
+        address = ipaddress.ip_address(ip)
+        value = int(address)
+        if address.version == 4:
+            i = np.searchsorted(v4_starts, value, side="right") - 1
+            return bool(i >= 0 and value <= v4_ends[i])
+        i = bisect.bisect_right(v6_starts, value) - 1
+        return i >= 0 and value <= v6_ends[i]
+
+    def lookup_many(self, ips):
+        """
+        Checks a whole array of addresses at once.
+
+        Args:
+            ips: Sequence of IPv4 or IPv6 address strings.
+
+        Returns:
+            numpy.ndarray: 1 for high-risk addresses and 0 otherwise, in input order.
+        """
+        v4_starts, v4_ends, v6_starts, v6_ends = self._tables
+        ips = [str(ip) for ip in ips]
+        result = np.zeros(len(ips), dtype=np.uint8)
+        if not ips:
+            return result
+
+        # inet_pton packs a dotted quad in well under a microsecond; the packed words are
+        # then read as one big-endian array. Anything else goes through ipaddress.
+        packed = []
+        others = []
+        for index, ip in enumerate(ips):
+            try:
+                packed.append(socket.inet_pton(socket.AF_INET, ip))
+            except OSError:
+                packed.append(b"\xff\xff\xff\xff")
+                others.append(index)
+        values = np.frombuffer(b"".join(packed), dtype=">u4").astype(np.int64)
+
+        v4 = np.ones(len(ips), dtype=bool)
+        for index in others:
+            address = ipaddress.ip_address(ips[index])
+            if address.version == 4:
+                values[index] = int(address)
+            else:
+                v4[index] = False
+                i = bisect.bisect_right(v6_starts, int(address)) - 1
+                result[index] = i >= 0 and int(address) <= v6_ends[i]
+
+        if v4.any():
+            result[v4] = self.lookup_ipv4_ints(values[v4])
+        return result
+
+    def lookup_ipv4_ints(self, values):
+        """
+        Checks an array of IPv4 addresses given as integers, e.g. generated synthetic data.
+
+        Returns:
+            numpy.ndarray: 1 for high-risk addresses and 0 otherwise.
+        """
+        v4_starts, v4_ends, _, _ = self._tables
+        values = np.asarray(values, dtype=np.int64)
+        if len(v4_starts) == 0:
+            return np.zeros(len(values), dtype=np.uint8)
+        i = np.searchsorted(v4_starts, values, side="right") - 1
+        return ((i >= 0) & (values <= v4_ends[np.maximum(i, 0)])).astype(np.uint8)
+
+
+def load_index(default_entries):
+    """
+    Builds the index from the WARDROBING_IP_BLOCKLIST file if set, else from default_entries.
+    """
+    path = os.environ.get("WARDROBING_IP_BLOCKLIST")
+    if path:
+        return IPRiskIndex(path=path)
+    return IPRiskIndex(default_entries)
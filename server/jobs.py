@@ -0,0 +1,151 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+from metrics import log
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue is at its maximum depth.
+    """
+
+
+class Job:
+    """
+    State of one queued return assessment.
+    """
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = "queued"
+        self.stages = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "stages": dict(self.stages),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == "done":
+            job["result"] = self.result
+        elif self.status == "failed":
+            job["error"] = self.error
+        return job
+
+
+class JobManager:
+    """
+    Runs return assessments on a local pool of worker threads.
+
+    Submitted jobs wait in a bounded queue; once it is full new submissions are
+    rejected instead of piling up. The job function receives an on_stage(stage, status)
+    callback so clients can follow its progress. Finished jobs are kept for
+    result_ttl seconds and then forgotten.
+
+    Worker threads start with the first submission, in the process that submits, so a
+    manager created before a pre-fork server forks still gets workers in each child.
+    Jobs live in the memory of the process that runs them.
+
+    Args:
+        workers (int): Number of worker threads.
+        max_queue (int): Jobs allowed to wait for a worker.
+        result_ttl (float): Seconds a finished job stays available.
+    """
+
+    def __init__(self, workers=2, max_queue=32, result_ttl=600):
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        self._pid = None
+
+    def _start_workers(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._workers = []
+            for index in range(self.workers):
+                worker = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, on_stage=..., **kwargs) and returns the new job's ID.
+
+        Raises:
+            QueueFullError: If max_queue jobs are already waiting.
+        """
+        self._start_workers()
+        self._purge_expired()
+        job = Job(uuid.uuid4().hex)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait((job, fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise QueueFullError(f"Job queue is full ({self._queue.maxsize} waiting)")
+        return job.id
+
+    def get(self, job_id):
+        """
+        Returns the job as a dict, or None if it does not exist or has expired.
+        """
+        self._purge_expired()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job is not None else None
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and now - job.finished_at > self.result_ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            job, fn, args, kwargs = self._queue.get()
+
+            def on_stage(stage, status, job=job):
+                with self._lock:
+                    job.stages[stage] = status
+
+            with self._lock:
+                job.status = "running"
+                job.started_at = time.time()
+            try:
+                result = fn(*args, on_stage=on_stage, **kwargs)
+                with self._lock:
+                    job.result = result
+                    job.status = "done"
+            except Exception as e:
+                log(f"Job {job.id} failed: {e}", level=logging.ERROR, exc_info=True, job_id=job.id, error=str(e))
+                with self._lock:
+                    job.error = str(e)
+                    job.status = "failed"
+            finally:
+                with self._lock:
+                    job.finished_at = time.time()
+                self._queue.task_done()
@@ -0,0 +1,227 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cached NMS up to a slow LLM call
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# GOODTOGO_LOG_FORMAT=json replaces the plain prints with one JSON object per line
+STRUCTURED_LOGS = os.environ.get("GOODTOGO_LOG_FORMAT") == "json"
+
+logger = logging.getLogger("goodtogo")
+if STRUCTURED_LOGS and not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get("GOODTOGO_LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+
+
+def log(message, level=logging.INFO, exc_info=False, **fields):
+    """
+    Prints a message, or logs it as a JSON line with its fields when GOODTOGO_LOG_FORMAT=json.
+
+    With exc_info=True the traceback of the exception being handled is added, as a
+    "traceback" field in JSON lines.
+    """
+    trace = traceback.format_exc() if exc_info else None
+    if not STRUCTURED_LOGS:
+        print(message)
+        if trace:
+            print(trace, end="")
+        return
+    if logger.isEnabledFor(level):
+        record = {"time": round(time.time(), 3), "level": logging.getLevelName(level), "message": message,
+                  **fields}
+        if trace:
+            record["traceback"] = trace
+        logger.log(level, json.dumps(record, default=str))
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [(name, value) for name, value in zip(labelnames, values)] + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic count per label combination.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Counter):
+    """
+    Current value per label combination, which can go down as well as up.
+    """
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count per label combination, as Prometheus expects them.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + "_bucket", _format_labels(self.labelnames, key, [("le", _format_value(bound))]), count
+            yield self.name + "_sum", _format_labels(self.labelnames, key), total
+            yield self.name + "_count", _format_labels(self.labelnames, key), counts[-1]
+
+
+class MetricsRegistry:
+    """
+    Holds the process's metrics and renders them in the Prometheus text format.
+
+    Metrics live in process memory, so each server process reports its own figures.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "goodtogo_stage_seconds", "Time spent in each pipeline stage.", ("stage", "target"))
+REQUESTS = REGISTRY.counter(
+    "goodtogo_requests_total", "Return assessment requests by mode and HTTP status.", ("mode", "status"))
+DETECTIONS = REGISTRY.counter(
+    "goodtogo_detections_total", "Detections returned by each model.", ("model",))
+ERRORS = REGISTRY.counter(
+    "goodtogo_errors_total", "Failures by pipeline stage.", ("stage",))
+BATCH_SIZE = REGISTRY.histogram(
+    "goodtogo_batch_size", "Images per batched forward across requests.", ("model",), BATCH_SIZE_BUCKETS)
+BATCH_QUEUE_DEPTH = REGISTRY.gauge(
+    "goodtogo_batch_queue_depth", "Forwards waiting to be batched.", ("model",))
+BATCH_WAIT_SECONDS = REGISTRY.histogram(
+    "goodtogo_batch_wait_seconds", "Time a forward waited for its batch to start.", ("model",))
+
+# Per-request list of (stage, target, seconds), set while a request is being timed
+_timings = contextvars.ContextVar("goodtogo_timings", default=None)
+
+
+@contextmanager
+def timed(stage, target=""):
+    """
+    Records how long the block takes in the stage histogram, and in the current request's
+    breakdown if one is being collected. Exceptions are counted as errors of the stage.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage, target=target)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((stage, target, elapsed))
+
+def start_timings():
+    """
+    Starts collecting every timed() block run in the current context, and in contexts
+    copied from it such as executor tasks, into the returned list.
+    """
+    timings = []
+    _timings.set(timings)
+    return timings
+
+def summarize_timings(timings):
+    """
+    Sums a collected breakdown into milliseconds per "stage" or "stage:target".
+    """
+    summary = {}
+    for stage, target, elapsed in list(timings):
+        name = f"{stage}:{target}" if target else stage
+        summary[name] = summary.get(name, 0.0) + elapsed * 1000
+    return {name: round(milliseconds, 3) for name, milliseconds in summary.items()}
@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from backends import ModelPool, variant_path
+from metrics import log
+from scheduler import MAX_BATCH, MAX_WAIT, BatchScheduler
+from yolo import INPUT_SIZE, check_yaml, class_dict, model_dict, yaml_load
+
+
+class ModelsNotReadyError(Exception):
+    """
+    Raised when models are requested before the registry has finished loading them.
+    """
+
+
+class ModelRegistry:
+    """
+    Loads the detectors in model_paths once, warms them up and hot-swaps updated weights.
+
+    Each model is loaded into a ModelPool and run once on a blank input before it is
+    published, so the first real request does not pay for graph allocation. Requests
+    take a snapshot of the current pools with models(); when a weights file changes,
+    the new pool is loaded and warmed next to the old one and then swapped in, so
+    requests already holding the old pool finish on it undisturbed.
+
+    With max_batch above 1, every pool is published behind a BatchScheduler that
+    batches forwards from concurrent requests.
+
+    Args:
+        model_paths (dict): Model name to {"weights", "classes", "backend", "instances", "options"},
+            the same config init_routes used to pass to add_model.
+        warmup (bool): Run a warm-up forward on every instance after loading.
+        max_batch (int): Most images a BatchScheduler runs in one forward, 1 to run requests on their own.
+        max_wait (float): Seconds a BatchScheduler waits for a batch to fill.
+    """
+
+    def __init__(self, model_paths, warmup=True, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.model_paths = model_paths
+        self.warmup = warmup
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._models = {}
+        self._status = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._error = None
+        self._watcher = None
+
+    def _file_signature(self, path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def _load(self, model_name):
+        config = self.model_paths[model_name]
+        started = time.time()
+        weights = variant_path(config["weights"], config.get("variant", "fp32"))
+        signature = self._file_signature(weights)
+        pool = ModelPool(weights, config.get("backend", "cv2"), config.get("instances", 1),
+                         **config.get("options", {}))
+        classes = yaml_load(check_yaml(config["classes"]))["names"]
+        loaded = time.time()
+
+        if self.warmup:
+            pool.warm_up(np.zeros((1, 3, INPUT_SIZE, INPUT_SIZE), np.float32))
+        warmed = time.time()
+        model = pool
+        if self.max_batch > 1:
+            model = BatchScheduler(pool, self.max_batch, self.max_wait, name=model_name)
+
+        with self._lock:
+            # Publish classes before the pool so no request sees a model without its labels
+            class_dict[model_name] = classes
+            replaced = self._models.get(model_name)
+            self._models[model_name] = model
+            model_dict[model_name] = model
+            self._status[model_name] = {
+                "version": pool.version,
+                "weights": weights,
+                "variant": config.get("variant", "fp32"),
+                "backend": pool.backend,
+                "instances": pool.size,
+                "max_batch": self.max_batch,
+                "loaded_at": loaded,
+                "load_seconds": round(loaded - started, 3),
+                "warmup_seconds": round(warmed - loaded, 3),
+                "signature": signature,
+            }
+        if isinstance(replaced, BatchScheduler):
+            replaced.close()
+        log(f"Loaded {model_name} version {pool.version} in {loaded - started:.2f}s "
+            f"(warm-up {warmed - loaded:.2f}s)", model=model_name, version=pool.version,
+            load_seconds=round(loaded - started, 3), warmup_seconds=round(warmed - loaded, 3))
+
+    def load_all(self):
+        """
+        Loads and warms every model, then marks the registry ready.
+        """
+        try:
+            for model_name in self.model_paths:
+                self._load(model_name)
+        except Exception as e:
+            self._error = str(e)
+            raise
+        self._ready.set()
+
+    def start(self, background=False):
+        """
+        Loads the models now, or in a background thread so the server can answer health checks meanwhile.
+        """
+        if not background:
+            self.load_all()
+            return
+        threading.Thread(target=self.load_all, name="model-loader", daemon=True).start()
+
+    def models(self, timeout=5.0):
+        """
+        Returns a snapshot of model name to pool, waiting up to timeout seconds for the initial load.
+        """
+        if not self._ready.wait(timeout):
+            raise ModelsNotReadyError(self._error or "Models are still loading")
+        with self._lock:
+            return dict(self._models)
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def reload_changed(self):
+        """
+        Reloads every model whose weights file changed on disk and returns their names.
+        """
+        reloaded = []
+        for model_name, config in self.model_paths.items():
+            try:
+                signature = self._file_signature(variant_path(config["weights"], config.get("variant", "fp32")))
+            except OSError:
+                continue  # mid-copy or removed, keep serving the current weights
+            with self._lock:
+                current = self._status.get(model_name, {}).get("signature")
+            if signature != current:
+                try:
+                    self._load(model_name)
+                    reloaded.append(model_name)
+                except Exception as e:
+                    log(f"Could not reload {model_name}, keeping the current weights: {e}", level=logging.ERROR,
+                        model=model_name, error=str(e))
+        return reloaded
+
+    def watch(self, interval=30.0):
+        """
+        Polls the weights files every interval seconds and hot-swaps the ones that changed.
+        """
+        def poll():
+            while True:
+                time.sleep(interval)
+                if self.is_ready():
+                    self.reload_changed()
+
+        self._watcher = threading.Thread(target=poll, name="model-watcher", daemon=True)
+        self._watcher.start()
+
+    def status(self):
+        """
+        Returns readiness plus version, backend and load timings per model.
+        """
+        with self._lock:
+            models = {
+                model_name: {key: value for key, value in status.items() if key != "signature"}
+                for model_name, status in self._status.items()
+            }
+        return {"ready": self.is_ready(), "error": self._error, "models": models}
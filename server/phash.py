@@ -0,0 +1,166 @@
+import itertools
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from sqlite_connection import SQLiteConnection
+
+HASH_BITS = 64
+# Hashes are split into this many 16-bit chunks for multi-index hashing
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+# Photos this close within one return are treated as the same shot
+DUPLICATE_DISTANCE = int(os.environ.get("GOODTOGO_DUPLICATE_DISTANCE", "4"))
+# Photos this close to one from an earlier return count as reused
+REUSE_DISTANCE = int(os.environ.get("GOODTOGO_REUSE_DISTANCE", "6"))
+
+
+def phash(image):
+    """
+    64-bit DCT perceptual hash of an image.
+
+    The image is shrunk to 32x32 grey, and the lowest 8x8 DCT frequencies are compared
+    with their median. Rescaling, recompression and small crops or colour changes
+    flip only a few bits, so visually identical photos end up a small Hamming
+    distance apart.
+
+    Args:
+        image (numpy.ndarray): BGR image.
+
+    Returns:
+        int: The hash as an unsigned 64-bit integer.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    # The DC term only reflects overall brightness, so it is left out of the median
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+def hamming_matrix(hashes_a, hashes_b):
+    """
+    Pairwise Hamming distances between two lists of 64-bit hashes.
+    """
+    a = np.asarray(hashes_a, dtype=np.uint64).reshape(-1, 1)
+    b = np.asarray(hashes_b, dtype=np.uint64).reshape(1, -1)
+    differing = np.bitwise_xor(a, b)
+    return np.unpackbits(differing.view(np.uint8).reshape(*differing.shape, 8), axis=-1).sum(axis=-1)
+
+def find_duplicates(hashes, max_distance=DUPLICATE_DISTANCE):
+    """
+    Maps every photo to the first earlier photo in the list it duplicates, or to itself.
+
+    Returns:
+        list[int]: Source index per photo; photos whose source is themselves are unique.
+    """
+    if not hashes:
+        return []
+    distances = hamming_matrix(hashes, hashes)
+    sources = []
+    for index in range(len(hashes)):
+        earlier = [source for source in np.flatnonzero(distances[index, :index] <= max_distance)
+                   if sources[source] == source]
+        sources.append(int(earlier[0]) if earlier else index)
+    return sources
+
+def _chunks(value):
+    return [(value >> (CHUNK_BITS * i)) & ((1 << CHUNK_BITS) - 1) for i in range(CHUNKS)]
+
+def _neighbours(chunk, radius):
+    # Every chunk value within radius bits of chunk
+    values = [chunk]
+    for flips in range(1, radius + 1):
+        for positions in itertools.combinations(range(CHUNK_BITS), flips):
+            flipped = chunk
+            for position in positions:
+                flipped ^= 1 << position
+            values.append(flipped)
+    return values
+
+def _signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class PhotoHashIndex:
+    """
+    Persistent index of past return photos, searchable by Hamming distance.
+
+    Uses multi-index hashing: each 64-bit hash is stored with its four 16-bit chunks,
+    each chunk column indexed. Two hashes within distance r must agree to within
+    r // 4 bits on at least one chunk, so a query only looks up the chunk values near
+    its own and checks the full distance of those candidates. With r around 8 that is
+    a few hundred index probes however many millions of photos are stored.
+
+    Args:
+        path (str): SQLite database file; ":memory:" keeps the index for this process only.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = SQLiteConnection(path, self._create_tables)
+
+    @staticmethod
+    def _create_tables(connection):
+        columns = ", ".join(f"c{i} INTEGER NOT NULL" for i in range(CHUNKS))
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS photos (id INTEGER PRIMARY KEY, hash INTEGER NOT NULL, {columns}, "
+            f"return_id TEXT NOT NULL, customer_id TEXT, created_at REAL NOT NULL)")
+        for i in range(CHUNKS):
+            connection.execute(f"CREATE INDEX IF NOT EXISTS photos_c{i} ON photos (c{i})")
+
+    def add(self, hashes, return_id, customer_id=None):
+        """
+        Stores the hashes of one return's photos.
+        """
+        now = time.time()
+        rows = [(_signed(value), *_chunks(value), return_id, customer_id, now) for value in hashes]
+        placeholders = ", ".join("?" * (CHUNKS + 4))
+        columns = ", ".join(f"c{i}" for i in range(CHUNKS))
+        with self._lock:
+            connection = self._db.get()
+            connection.executemany(
+                f"INSERT INTO photos (hash, {columns}, return_id, customer_id, created_at) VALUES ({placeholders})",
+                rows)
+            connection.commit()
+
+    def query(self, value, max_distance=REUSE_DISTANCE, limit=10):
+        """
+        Finds stored photos within max_distance of a hash.
+
+        Returns:
+            list[dict]: Closest matches first, each with return_id, customer_id, distance and created_at.
+        """
+        radius = max_distance // CHUNKS
+        matches = {}
+        with self._lock:
+            connection = self._db.get()
+            for i, chunk in enumerate(_chunks(value)):
+                neighbours = _neighbours(chunk, radius)
+                placeholders = ", ".join("?" * len(neighbours))
+                rows = connection.execute(
+                    f"SELECT id, hash, return_id, customer_id, created_at FROM photos WHERE c{i} IN ({placeholders})",
+                    neighbours).fetchall()
+                for row_id, stored, return_id, customer_id, created_at in rows:
+                    if row_id in matches:
+                        continue
+                    distance = bin((stored & ((1 << 64) - 1)) ^ value).count("1")
+                    if distance <= max_distance:
+                        matches[row_id] = {"return_id": return_id, "customer_id": customer_id,
+                                           "distance": distance, "created_at": created_at}
+        return sorted(matches.values(), key=lambda match: (match["distance"], match["created_at"]))[:limit]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.get().execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+
+
+def open_index():
+    """
+    Opens the index at GOODTOGO_PHOTO_INDEX, or an in-memory one when it is not set.
+    """
+    return PhotoHashIndex(os.environ.get("GOODTOGO_PHOTO_INDEX", ":memory:"))
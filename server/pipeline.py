@@ -0,0 +1,293 @@
+import base64
+import contextvars
+import io
+import os
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import PIL.Image
+
+from feature_store import customer_id
+from functions import images_from_bytes
+from metrics import log, start_timings, summarize_timings, timed
+from phash import find_duplicates, phash
+from wardrobing import is_wardrobe
+from yolo import annotate_image, detect_images, detect_tiled, detections_to_json
+
+JPEG_QUALITY = 95
+# Longest side photos are decoded at (at least); 0 decodes at full resolution
+DECODE_MAX_SIDE = int(os.environ.get("GOODTOGO_DECODE_MAX_SIDE", "1280"))
+# Also run full-resolution tiles through the detectors to catch small defects; pair with a larger
+# GOODTOGO_DECODE_MAX_SIDE (or 0) so the tiles have pixels to work with
+TILED_INFERENCE = os.environ.get("GOODTOGO_TILED_INFERENCE") == "1"
+# Report tracemalloc peak memory per request; slows allocations down, so off by default
+TRACE_MEMORY = os.environ.get("GOODTOGO_TRACE_MEMORY") == "1"
+# Add a per-stage timing breakdown to every response, not only those asking with ?timings=1
+RESPONSE_TIMINGS = os.environ.get("GOODTOGO_RESPONSE_TIMINGS") == "1"
+
+# EXIF tag holding how the camera was rotated; values 5 to 8 turn the photo a quarter turn
+EXIF_ORIENTATION = 0x0112
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def decode_upload(data, max_side=DECODE_MAX_SIDE):
+    """
+    Decodes an uploaded photo from its bytes, at reduced resolution when it is much
+    larger than needed.
+
+    JPEG decoders can skip straight to 1/2, 1/4 or 1/8 scale, so a 12 MP phone photo
+    never has to exist at full size in memory. The largest reduction that still
+    leaves the longest side at or above max_side is used.
+
+    Args:
+        data (bytes): Encoded image as sent by the client.
+        max_side (int): Smallest acceptable longest side after reduction, 0 for full resolution.
+
+    Returns:
+        tuple: (BGR image, (x factor, y factor) from decoded pixels to full-size pixels of the upright photo)
+    """
+    flag, factor = cv2.IMREAD_COLOR, 1
+    if max_side:
+        try:
+            # Only the header is read here, the pixels stay encoded
+            header = PIL.Image.open(io.BytesIO(data))
+            width, height = header.size
+            # imdecode applies the EXIF orientation, so a rotated photo comes out with its sides swapped
+            if header.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+                width, height = height, width
+        except Exception:
+            width = height = 0
+        for reduction, reduced_flag in REDUCED_DECODE_FLAGS:
+            if max(width, height) // reduction >= max_side:
+                flag, factor = reduced_flag, reduction
+                break
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if image is None:
+        raise ValueError("Could not decode uploaded photo")
+    if factor > 1:
+        # Reduced decoding rounds each side up on its own, so derive an exact factor per axis
+        return image, (width / image.shape[1], height / image.shape[0])
+    return image, (1.0, 1.0)
+
+def encode_image(image, quality=JPEG_QUALITY):
+    """
+    Encodes a BGR image as base64 JPEG for the JSON response.
+    """
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not encode annotated photo")
+    return base64.b64encode(buffer.tobytes()).decode("utf-8")
+
+@contextmanager
+def _stage(on_stage, name):
+    if on_stage is None:
+        yield
+        return
+    on_stage(name, "running")
+    try:
+        yield
+    except Exception:
+        on_stage(name, "failed")
+        raise
+    on_stage(name, "done")
+
+def iter_return_pipeline(photo_bytes, price, user_data, models, assessment_engine, cache=None, on_stage=None,
+                         image_store=None, photo_index=None, feature_store=None):
+    """
+    Assesses one return entirely in memory, yielding each result as soon as it is ready.
+
+    Photos are decoded once from the request bytes, run through the detectors,
+    annotated in place and encoded once. The assessment prompts get the original
+    photos and are started first, since they are the slowest stage; wardrobing,
+    detections and annotated images are yielded while they are in flight. Nothing
+    is written to or re-read from disk, so concurrent requests never share files.
+
+    Every photo is perceptually hashed. Near-duplicates within the return skip
+    detection and the prompts and reuse the first copy's detections. Photos matching
+    an earlier return from another known customer are counted in "reused_photos" and
+    listed by index for the caller to act on; which customers and returns they match
+    is only logged, so one customer's returns are never shown to another. The
+    wardrobing prediction itself comes from the model alone.
+
+    Args:
+        photo_bytes (list[bytes]): Uploaded photos as sent by the client.
+        price (str): Original price of the product.
+        user_data (dict): Customer data for the wardrobing check.
+        models (dict): Model name to ModelPool, as filled in by add_model.
+        assessment_engine (AssessmentEngine): Engine running the grading, action and repair prompts.
+        cache (ResultCache): Optional cache shared with detect_images.
+        on_stage (callable): Optional on_stage(stage, status) callback, called with "running",
+            "done" or "failed" for the decode, detection, annotation, assessment and wardrobing stages.
+        image_store (AnnotatedImageStore): Where annotated photos are kept for GET /api/images.
+            Without one, the full annotated photos are inlined as base64.
+        photo_index (PhotoHashIndex): Index of earlier returns' photos; this return's photos are
+            added once it has been assessed.
+        feature_store (CustomerFeatureStore): Recorded purchase and return totals used by the
+            wardrobing check in place of the ones in user_data.
+
+    Yields:
+        tuple: (stage, result) where stage is "photo_matches", "wardrobing_result", "detections"
+        or "image" (result is {"index", ...} for one photo), or one of the assessment kinds.
+    """
+    with _stage(on_stage, "decode"), timed("decode"):
+        decoded = [decode_upload(data) for data in photo_bytes]
+        images = [image for image, _ in decoded]
+        decode_factors = [factor for _, factor in decoded]
+
+    with _stage(on_stage, "photo_matching"), timed("phash"):
+        hashes = [phash(image) for image in images]
+        sources = find_duplicates(hashes)
+        unique = [index for index, source in enumerate(sources) if source == index]
+        customer = customer_id(user_data)
+        reused = {}
+        if photo_index is not None:
+            for index in unique:
+                # Only a known, different customer counts; an anonymous customer may be resubmitting their own photos
+                matches = [match for match in photo_index.query(hashes[index])
+                           if customer is not None and match["customer_id"] is not None
+                           and match["customer_id"] != customer]
+                if matches:
+                    reused[index] = matches
+    return_id = uuid.uuid4().hex
+    reused_photos = len(reused)
+    if reused_photos:
+        # Which customers and returns matched stays in the server log, never in the response
+        log(f"Return {return_id} reuses {reused_photos} photos from earlier returns", return_id=return_id,
+            customer_id=customer, reused_photos=reused_photos,
+            matches={index: [{"return_id": match["return_id"], "customer_id": match["customer_id"],
+                              "distance": match["distance"]} for match in matches]
+                     for index, matches in reused.items()})
+
+    if on_stage is not None:
+        on_stage("assessment", "running")
+    # Only one copy of each near-duplicate goes to the prompts
+    with timed("decode"):
+        pil_images = images_from_bytes([photo_bytes[index] for index in unique], DECODE_MAX_SIDE)
+    assessment = assessment_engine.iter_assess(pil_images, price)
+
+    yield "photo_matches", {
+        "return_id": return_id,
+        "duplicates": {index: source for index, source in enumerate(sources) if source != index},
+        "reused_photos": reused_photos,
+        "reused_photo_indices": sorted(reused),
+    }
+
+    with _stage(on_stage, "wardrobing"), timed("wardrobing"):
+        wardrobing_result = is_wardrobe(user_data, feature_store)
+    yield "wardrobing_result", wardrobing_result
+
+    with _stage(on_stage, "detection"):
+        detect = detect_tiled if TILED_INFERENCE else detect_images
+        unique_detections = detect(models, [images[index] for index in unique], cache=cache,
+                                   image_bytes=[photo_bytes[index] for index in unique])
+        by_index = dict(zip(unique, unique_detections))
+        # Near-duplicates are the same shot, so the boxes carry over to their decoded size
+        detections = []
+        for index, source in enumerate(sources):
+            ratio = (decode_factors[source][0] / decode_factors[index][0],
+                     decode_factors[source][1] / decode_factors[index][1])
+            detections.append({model_name: _scale_boxes(model_detections, ratio)
+                               for model_name, model_detections in by_index[source].items()})
+    for index, image_detections in enumerate(detections):
+        yield "detections", {"index": index,
+                             "detections": detections_to_json(image_detections, decode_factors[index])}
+
+    with _stage(on_stage, "annotation"):
+        for index, (image, image_detections) in enumerate(zip(images, detections)):
+            annotate_image(image, image_detections)
+            with timed("encode"):
+                if image_store is not None:
+                    # Served by URL; only a small preview travels in the response
+                    stored = image_store.put(image)
+                    event = {"index": index, "image": stored.pop("preview"), "ref": stored}
+                else:
+                    event = {"index": index, "image": encode_image(image)}
+            yield "image", event
+            images[index] = None  # the encoded copy has been sent, drop the pixels
+
+    with _stage(on_stage, "assessment"):
+        for kind, answer in assessment:
+            yield kind, answer
+
+    if photo_index is not None:
+        photo_index.add([hashes[index] for index in unique], return_id, customer)
+
+def _scale_boxes(detections, ratio):
+    # ratio is an (x, y) pair
+    if ratio == (1.0, 1.0):
+        return detections
+    detections = detections.copy()
+    for field, axis in (("x1", 0), ("y1", 1), ("x2", 0), ("y2", 1)):
+        detections[field] *= ratio[axis]
+    return detections
+
+def track_memory(events):
+    """
+    Passes pipeline events through and appends a ("peak_memory_bytes", bytes) event at the end.
+
+    Peak memory comes from tracemalloc, which sees NumPy and OpenCV buffers. It is
+    process-wide, so requests that overlap with this one are included in the figure.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    yield from events
+    _, peak = tracemalloc.get_traced_memory()
+    log(f"Peak memory for request: {(peak - start) / 2**20:.1f} MiB", peak_memory_bytes=peak - start)
+    yield "peak_memory_bytes", peak - start
+
+def track_timings(events):
+    """
+    Passes pipeline events through and appends a ("timings_ms", {stage: milliseconds}) event at the end.
+
+    The pipeline runs in its own context so only this request's timed() blocks are
+    counted, including the assessment calls running on the engine's threads.
+    """
+    context = contextvars.copy_context()
+    timings = context.run(start_timings)
+    events = iter(events)
+    while True:
+        try:
+            event = context.run(next, events)
+        except StopIteration:
+            break
+        yield event
+    yield "timings_ms", summarize_timings(timings)
+
+def run_return_pipeline(photo_bytes, price, user_data, models, assessment_engine, cache=None, on_stage=None,
+                        image_store=None, timings=RESPONSE_TIMINGS, photo_index=None, feature_store=None):
+    """
+    Runs iter_return_pipeline to completion and builds the JSON response body.
+
+    With timings=True the body also gets a "timings_ms" breakdown per stage.
+
+    Returns:
+        dict: JSON-serializable response body.
+    """
+    response = {
+        "message": "Data received and photos uploaded successfully!",
+        "images": [None] * len(photo_bytes),
+        "detections": [None] * len(photo_bytes),
+    }
+    events = iter_return_pipeline(photo_bytes, price, user_data, models, assessment_engine, cache, on_stage,
+                                  image_store, photo_index, feature_store)
+    if timings:
+        events = track_timings(events)
+    if TRACE_MEMORY:
+        events = track_memory(events)
+    for stage, result in events:
+        if stage == "image":
+            response["images"][result["index"]] = result["image"]
+            if "ref" in result:
+                response.setdefault("image_refs", [None] * len(photo_bytes))[result["index"]] = result["ref"]
+        elif stage == "detections":
+            response["detections"][result["index"]] = result["detections"]
+        else:
+            response[stage] = result
+    return response
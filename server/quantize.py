@@ -0,0 +1,297 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from backends import MODEL_VARIANTS as VARIANTS, load_backend, variant_path
+from metrics import log
+from yolo import CONF_THRESHOLD, IOU_THRESHOLD, box_iou, decode_outputs, detection_boxes, preprocess_images
+
+try:
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic,
+                                          quantize_static)
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+except ImportError:  # quantization needs onnx and onnxruntime, serving FP32 models does not
+    onnx = None
+    CalibrationDataReader = object
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.webp")
+# Ops that decode boxes after the last head convolutions; INT8 rounding there moves every box
+HEAD_DECODE_OPS = {"Add", "Concat", "Div", "Mul", "Reshape", "Sigmoid", "Slice", "Softmax", "Split", "Sub",
+                   "Transpose"}
+
+
+def image_paths(folder):
+    return sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(folder, pattern)))
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    """
+    Feeds sample photos, preprocessed exactly like served requests, to static quantization.
+
+    Args:
+        images (list[str]): Paths of the calibration photos.
+        input_name (str): Name of the model input.
+    """
+
+    def __init__(self, images, input_name):
+        self.images = list(images)
+        self.input_name = input_name
+        self._next = 0
+
+    def get_next(self):
+        while self._next < len(self.images):
+            image = cv2.imread(self.images[self._next])
+            self._next += 1
+            if image is not None:
+                blob, _ = preprocess_images([image])
+                return {self.input_name: blob}
+        return None
+
+    def rewind(self):
+        self._next = 0
+
+
+def head_decode_nodes(model):
+    """
+    Names of the nodes that decode boxes after the last convolutions of the detection head.
+
+    Found by walking back from the graph outputs through element-wise and reshaping ops
+    until a convolution or other op is reached. In YOLOv8 these nodes join box
+    coordinates in pixels with class scores in 0-1 into one tensor, which a single INT8
+    scale cannot represent without rounding the scores away.
+    """
+    producers = {output: node for node in model.graph.node for output in node.output}
+    pending = [output.name for output in model.graph.output]
+    excluded = []
+    seen = set()
+    while pending:
+        node = producers.get(pending.pop())
+        if node is None or node.name in seen or node.op_type not in HEAD_DECODE_OPS:
+            continue
+        seen.add(node.name)
+        excluded.append(node.name)
+        pending.extend(node.input)
+    return excluded
+
+def build_variant(weights, variant, calibration_images=(), output_path=None, keep_head_fp32=True):
+    """
+    Writes a quantized or half-precision copy of an FP32 ONNX model.
+
+    "int8-dynamic" stores weights as INT8 and quantizes activations on the fly, so it
+    needs no calibration data. "int8-static" also fixes activation ranges from the
+    calibration images and produces QDQ graphs that onnxruntime fuses into integer
+    kernels. "fp16" halves the weights but keeps FP32 inputs and outputs. Run the
+    INT8 variants with the onnxruntime backend; cv2.dnn lacks several of their ops.
+
+    Args:
+        weights (str): Path to the FP32 ONNX model.
+        variant (str): One of VARIANTS other than "fp32".
+        calibration_images (list[str]): Photos used to calibrate "int8-static".
+        output_path (str): Where to write the variant, variant_path(weights, variant) by default.
+        keep_head_fp32 (bool): Leave the box-decoding nodes of the detection head in FP32.
+
+    Returns:
+        str: Path of the written model.
+    """
+    if onnx is None:
+        raise ImportError("onnx and onnxruntime are needed to build model variants; "
+                          "pip install onnx onnxruntime")
+    if variant == "fp32":
+        return weights
+    output_path = output_path or variant_path(weights, variant)
+    model = onnx.load(weights)
+    excluded = head_decode_nodes(model) if keep_head_fp32 else []
+
+    if variant == "fp16":
+        onnx.save(convert_float_to_float16(model, keep_io_types=True), output_path)
+    elif variant == "int8-dynamic":
+        quantize_dynamic(weights, output_path, weight_type=QuantType.QUInt8, nodes_to_exclude=excluded)
+    elif variant == "int8-static":
+        calibration_images = list(calibration_images)
+        if not calibration_images:
+            raise ValueError("int8-static needs calibration images")
+        reader = ImageCalibrationReader(calibration_images, model.graph.input[0].name)
+        quantize_static(weights, output_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        nodes_to_exclude=excluded)
+    else:
+        raise ValueError(f"Unknown model variant '{variant}', expected one of {list(VARIANTS)}")
+    log(f"Wrote {variant} variant of {weights} to {output_path} "
+        f"({os.path.getsize(output_path) / 2**20:.1f} MiB)", variant=variant, path=output_path)
+    return output_path
+
+def _rss_bytes():
+    # Resident memory from /proc, which unlike tracemalloc sees the inference runtime's allocations
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def average_precision(reference, candidate, iou_threshold=0.5):
+    """
+    mAP of candidate detections, scoring the reference detections as ground truth.
+
+    Args:
+        reference (list[numpy.ndarray]): DETECTION_DTYPE arrays per image from the FP32 model.
+        candidate (list[numpy.ndarray]): DETECTION_DTYPE arrays per image from the variant.
+        iou_threshold (float): IoU a candidate box needs with a reference box of its class to count.
+
+    Returns:
+        dict: "map" over classes in the reference, plus "precision", "recall" and the "mean_iou" of matched boxes.
+    """
+    classes = sorted(set(np.concatenate([detections["class_id"] for detections in reference]).tolist()))
+    true_positives = 0
+    matched_iou = []
+    total_candidates = sum(len(detections) for detections in candidate)
+    total_reference = sum(len(detections) for detections in reference)
+    average_precisions = []
+
+    for class_id in classes:
+        scored = []
+        positives = 0
+        for expected, actual in zip(reference, candidate):
+            expected = expected[expected["class_id"] == class_id]
+            actual = actual[actual["class_id"] == class_id]
+            positives += len(expected)
+            if len(actual) == 0:
+                continue
+            iou = box_iou(detection_boxes(actual), detection_boxes(expected))
+            taken = np.zeros(len(expected), dtype=bool)
+            # Highest confidence first, each reference box matched at most once
+            for row in np.argsort(-actual["confidence"], kind="stable"):
+                best = -1
+                if len(expected):
+                    overlaps = np.where(taken, -1.0, iou[row])
+                    best = int(overlaps.argmax())
+                    if overlaps[best] < iou_threshold:
+                        best = -1
+                if best >= 0:
+                    taken[best] = True
+                    matched_iou.append(float(iou[row, best]))
+                scored.append((float(actual["confidence"][row]), best >= 0))
+
+        if not scored:
+            average_precisions.append(0.0)
+            continue
+        scored.sort(key=lambda item: -item[0])
+        hits = np.array([hit for _, hit in scored], dtype=np.float64)
+        true_positives += int(hits.sum())
+        cumulative = np.cumsum(hits)
+        recall = cumulative / max(positives, 1)
+        precision = cumulative / np.arange(1, len(hits) + 1)
+        # All-point interpolation: precision made monotonic, integrated over recall steps
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        steps = np.diff(np.concatenate([[0.0], recall]))
+        average_precisions.append(float((steps * precision).sum()))
+
+    return {
+        "map": round(float(np.mean(average_precisions)), 4) if average_precisions else None,
+        "precision": round(true_positives / total_candidates, 4) if total_candidates else None,
+        "recall": round(true_positives / total_reference, 4) if total_reference else None,
+        "mean_iou": round(float(np.mean(matched_iou)), 4) if matched_iou else None,
+    }
+
+def compare_variants(weights, images, variants=VARIANTS, backend="onnxruntime", repeats=3,
+                     conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD, **options):
+    """
+    Measures each variant of a model against its FP32 original on local photos.
+
+    Args:
+        weights (str): Path to the FP32 ONNX model; variants are looked up with variant_path.
+        images (list[str]): Photos to run.
+        variants (tuple[str]): Variants to measure; "fp32" is always included as the reference.
+        backend (str): Inference backend, "onnxruntime" unless comparing cv2-compatible variants.
+        repeats (int): Timed passes over the photos.
+        **options: Backend settings such as intra_op_threads.
+
+    Returns:
+        dict: Per variant, file size, resident memory added by loading it, per-image latency
+        percentiles, and detection agreement with FP32 (see average_precision).
+    """
+    decoded = [image for image in (cv2.imread(path) for path in images) if image is not None]
+    if not decoded:
+        raise ValueError("No readable images to compare variants on")
+    blobs = [preprocess_images([image])[0] for image in decoded]
+
+    report = {}
+    reference = None
+    for variant in ("fp32", *[variant for variant in variants if variant != "fp32"]):
+        path = variant_path(weights, variant)
+        if not os.path.exists(path):
+            report[variant] = {"error": f"{path} not found, build it first"}
+            continue
+
+        before = _rss_bytes()
+        model = load_backend(path, backend, **options)
+        outputs = [model.forward(blob) for blob in blobs]  # also warms the model up
+        after = _rss_bytes()
+
+        latencies = []
+        for _ in range(repeats):
+            for blob in blobs:
+                started = time.perf_counter()
+                model.forward(blob)
+                latencies.append(time.perf_counter() - started)
+
+        detections = [decode_outputs(output[0], conf_threshold, iou_threshold) for output in outputs]
+        if reference is None:
+            reference = detections
+        latencies = np.array(latencies) * 1000
+        report[variant] = {
+            "path": path,
+            "file_bytes": os.path.getsize(path),
+            "memory_bytes": after - before if before is not None and after is not None else None,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "mean_ms": round(float(latencies.mean()), 3),
+            "detections": int(sum(len(found) for found in detections)),
+            "agreement": average_precision(reference, detections),
+        }
+        del model
+    return report
+
+
+if __name__ == "__main__":
+    from routes import MODEL_PATHS
+
+    default_images = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mac-yolo")
+    parser = argparse.ArgumentParser(description="Build and compare quantized detector variants.")
+    parser.add_argument("command", choices=["build", "compare"])
+    parser.add_argument("--models", nargs="+", default=sorted(MODEL_PATHS), help="Models from MODEL_PATHS.")
+    parser.add_argument("--variants", nargs="+", default=[variant for variant in VARIANTS if variant != "fp32"],
+                        choices=VARIANTS)
+    parser.add_argument("--images", default=default_images, help="Folder of calibration and comparison photos.")
+    parser.add_argument("--quantize-head", action="store_true", help="Also quantize the box-decoding head.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed passes over the photos when comparing.")
+    parser.add_argument("--output", help="Write the comparison report to this JSON file.")
+    args = parser.parse_args()
+
+    photos = image_paths(args.images)
+    reports = {}
+    for model_name in args.models:
+        weights = MODEL_PATHS[model_name]["weights"]
+        if args.command == "build":
+            for variant in args.variants:
+                build_variant(weights, variant, photos, keep_head_fp32=not args.quantize_head)
+        else:
+            reports[model_name] = compare_variants(weights, photos, args.variants, repeats=args.repeats)
+            for variant, result in reports[model_name].items():
+                if "error" in result:
+                    log(f"{model_name} {variant}: {result['error']}")
+                    continue
+                log(f"{model_name} {variant}: p50 {result['p50_ms']}ms, {result['file_bytes'] / 2**20:.1f} MiB, "
+                    f"mAP vs fp32 {result['agreement']['map']}", model=model_name, variant=variant, **result)
+
+    if args.output and reports:
+        with open(args.output, "w") as output:
+            json.dump(reports, output, indent=2)
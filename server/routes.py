@@ -1,35 +1,156 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+import logging
 import os
-import base64
+import hmac
 import json
-from functions import condition_grading, recommended_action, recommended_repair  # Import all functions
+import tempfile
+from functools import wraps
+from cache import ResultCache
+from feature_store import open_feature_store
+from functions import AssessmentEngine
+from image_store import AnnotatedImageStore
+from inspect_stream import IoUTracker, StreamInspector
+from jobs import JobManager, QueueFullError
+from metrics import REGISTRY, REQUESTS, log, timed
+from model_registry import ModelRegistry, ModelsNotReadyError
+from phash import open_index
+from pipeline import (RESPONSE_TIMINGS, TRACE_MEMORY, decode_upload, iter_return_pipeline, run_return_pipeline,
+                      track_memory, track_timings)
 from wardrobing import *
 from yolo import *
 
-UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif'}
+# Bearer token for admin routes (reloads, batch scoring, customer events); without one they refuse every request
+ADMIN_TOKEN = os.environ.get("GOODTOGO_ADMIN_TOKEN")
+# ?mode=async keeps job state in process memory, so serve.py turns it off when forking several workers
+ASYNC_JOBS = os.environ.get("GOODTOGO_ASYNC_JOBS", "1") == "1"
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Yolo models loaded by init_routes
+# "backend" is "cv2" or "onnxruntime"; "options" are passed to the backend, e.g.
+# {"intra_op_threads": 2, "inter_op_threads": 1, "graph_optimization": "all"} for onnxruntime.
+# "instances" is how many independent copies serve concurrent requests.
+# "variant" picks "fp32" or a copy built by quantize.py ("fp16", "int8-dynamic", "int8-static");
+# the INT8 variants need the onnxruntime backend.
+MODEL_PATHS = {
+    "model1": {
+        "weights": "yoloResources/holes.onnx",
+        "classes": "yoloResources/clothingDefect.yaml",
+        "backend": "cv2",
+        "instances": 2,
+        "variant": "fp32",
+        "options": {}
+    },
+    "model2": {
+        "weights": "yoloResources/stainDetectorFR.onnx",
+        "classes": "yoloResources/stains.yaml",
+        "backend": "cv2",
+        "instances": 2,
+        "variant": "fp32",
+        "options": {}
+    }
+}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+class RequestError(Exception):
+    """
+    A malformed return request, reported to the client as a 400.
+    """
+
+def parse_return_request():
+    """
+    Reads the price, userData and photo bytes of a return from the current request.
+    """
+    # Get the price from the request (default to "100" if not provided)
+    price = request.form.get('price', '100')
+
+    # Correctly extract userData
+    if request.is_json:
+        userData = request.get_json().get('userData', {})
+    else:
+        userData = request.form.get('userData', '{}')  # Default to empty JSON string if missing
+        try:
+            userData = json.loads(userData)  # Convert string to dictionary
+        except json.JSONDecodeError:
+            raise RequestError("Invalid JSON in userData")
+
+    # Check if 'photos' part is present in the request
+    if 'photos' not in request.files:
+        raise RequestError("No photos part in the request")
+
+    # Read the photos straight from the request stream, nothing is saved to disk
+    photos = request.files.getlist('photos')
+    photo_bytes = [photo.read() for photo in photos if photo and allowed_file(photo.filename)]
+    if not photo_bytes:
+        raise RequestError("No photos with an allowed file type")
+
+    return price, userData, photo_bytes
+
+def admin_only(view):
+    """
+    Restricts a route to callers presenting GOODTOGO_ADMIN_TOKEN as a Bearer token.
+
+    Without a configured token the route is refused: behind a reverse proxy every
+    client looks local, so the caller's address proves nothing.
+    """
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        presented = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        allowed = bool(ADMIN_TOKEN) and hmac.compare_digest(presented.encode(), ADMIN_TOKEN.encode())
+        if not allowed:
+            return jsonify({"message": "Not authorized"}), 403
+        return view(*args, **kwargs)
+    return guarded
+
+def format_event(stage, result, sse=False):
+    """
+    Formats one pipeline result as an NDJSON line or a server-sent event.
+    """
+    body = json.dumps({"stage": stage, "result": result})
+    if sse:
+        return f"event: {stage}\ndata: {body}\n\n"
+    return body + "\n"
+
 def init_routes(app):
-    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-    # initialize Yolo Model
-    model_paths = {
-        "model1": {
-            "weights": "yoloResources/holes.onnx",
-            "classes": "yoloResources/clothingDefect.yaml"
-        },
-        "model2": {
-            "weights": "yoloResources/stainDetectorFR.onnx",
-            "classes": "yoloResources/stains.yaml"
-        }
-    }
-    # Load all models
-    for model_name, paths in model_paths.items():
-        add_model(model_name, paths["weights"], paths["classes"])
+    # Detections and assessments for photos we have already seen; GOODTOGO_CACHE_DIR adds a disk tier
+    result_cache = ResultCache(
+        max_entries=int(os.environ.get("GOODTOGO_CACHE_ENTRIES", "1024")),
+        ttl=float(os.environ.get("GOODTOGO_CACHE_TTL", str(24 * 3600))),
+        disk_dir=os.environ.get("GOODTOGO_CACHE_DIR"),
+    )
+    # Grading, action and repair prompts; set GOODTOGO_LLM_CLIENT=stub to run without Gemini
+    assessment_engine = AssessmentEngine(
+        timeout=float(os.environ.get("GOODTOGO_ASSESSMENT_TIMEOUT", "30")),
+        combined=os.environ.get("GOODTOGO_COMBINED_ASSESSMENT") == "1",
+        cache=result_cache,
+    )
+    # Annotated photos served from GET /api/images/<id>; the JSON only inlines small previews
+    image_store = AnnotatedImageStore(
+        quality=int(os.environ.get("GOODTOGO_JPEG_QUALITY", "90")),
+        thumbnail_sizes=tuple(int(size) for size in os.environ.get("GOODTOGO_THUMBNAIL_SIZES", "160,480").split(",")),
+        preview_size=int(os.environ.get("GOODTOGO_PREVIEW_SIZE", "480")),
+        disk_dir=os.environ.get("GOODTOGO_IMAGE_DIR"),
+    )
+    # Perceptual hashes of past return photos, kept in the GOODTOGO_PHOTO_INDEX SQLite file
+    photo_index = open_index()
+    # Per-customer purchase and return totals fed by /api/customers/events, kept in GOODTOGO_FEATURE_STORE
+    feature_store = open_feature_store()
+    # Background workers for ?mode=async returns
+    job_manager = JobManager(
+        workers=int(os.environ.get("GOODTOGO_JOB_WORKERS", "2")),
+        max_queue=int(os.environ.get("GOODTOGO_JOB_QUEUE", "32")),
+        result_ttl=float(os.environ.get("GOODTOGO_JOB_TTL", "600")),
+    )
+    # Load and warm up every model once; GOODTOGO_LAZY_MODELS=1 loads in the background while
+    # /api/ready reports 503, and changed .onnx files are hot-swapped every GOODTOGO_MODEL_WATCH_INTERVAL seconds
+    registry = ModelRegistry(MODEL_PATHS)
+    registry.start(background=os.environ.get("GOODTOGO_LAZY_MODELS") == "1")
+    watch_interval = float(os.environ.get("GOODTOGO_MODEL_WATCH_INTERVAL", "30"))
+    if watch_interval > 0:
+        registry.watch(watch_interval)
+    # Lets serve.py reload models in the master process before recycling its workers
+    app.extensions["goodtogo"] = {"registry": registry}
 
     @app.route('/api/data', methods=['GET'])
     def get_data():
@@ -41,81 +162,232 @@ def init_routes(app):
             'noRepairsNeeded': True,
             'withinReturnWindow': True
         }
-        print('Returning assessment data:', assessment_data)
+        log(f'Returning assessment data: {assessment_data}', assessment_data=assessment_data)
         return jsonify(assessment_data)
 
+    @app.route('/api/images/<image_id>', methods=['GET'])
+    def get_image(image_id):
+        # ?size= picks one of the thumbnail sizes; images are immutable, so clients can cache forever
+        size = request.args.get('size', type=int)
+        data = image_store.get(image_id, size)
+        if data is None:
+            return jsonify({"message": "Image not found or expired"}), 404
+
+        response = Response(data, mimetype='image/jpeg')
+        response.set_etag(image_id if size is None else f"{image_id}-{size}")
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+        return response.make_conditional(request)
+
+    @app.route('/api/health', methods=['GET'])
+    def health():
+        # Liveness plus model versions and load times
+        return jsonify(registry.status()), 200
+
+    @app.route('/api/ready', methods=['GET'])
+    def ready():
+        status = registry.status()
+        return jsonify(status), 200 if status["ready"] else 503
+
+    @app.route('/api/models/reload', methods=['POST'])
+    @admin_only
+    def reload_models():
+        return jsonify({"reloaded": registry.reload_changed(), **registry.status()}), 200
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        # Prometheus text format: stage timing histograms plus request, detection and error counters
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/api/cache/stats', methods=['GET'])
+    def cache_stats():
+        return jsonify(result_cache.stats())
+
+    @app.route('/api/wardrobing/batch', methods=['POST'])
+    @admin_only
+    def wardrobing_batch_route():
+        # Body is {"users": [userData, ...]} or {"columns": {"ip": [...], "amountBought": [...], ...}}.
+        # Bulk scoring is for the nightly job only; open to clients it would let them probe the fraud model
+        body = request.get_json(silent=True) or {}
+        records = body.get("users", body.get("columns"))
+        if records is None:
+            return jsonify({"message": "Expected a 'users' list or a 'columns' object"}), 400
+        chunk_size = max(1, request.args.get('chunk_size', 1000, type=int))
+
+        try:
+            predictions, probabilities = score_users(records)
+        except (KeyError, ValueError, TypeError) as e:
+            return jsonify({"message": f"Invalid user records: {str(e)}"}), 400
+
+        def generate():
+            for offset in range(0, len(predictions), chunk_size):
+                yield json.dumps({
+                    "offset": offset,
+                    "wardrobing_result": predictions[offset:offset + chunk_size].tolist(),
+                    "probability": probabilities[offset:offset + chunk_size].round(4).tolist(),
+                }) + "\n"
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    @app.route('/api/wardrobing/blocklist/reload', methods=['POST'])
+    @admin_only
+    def reload_blocklist_route():
+        # Only the WARDROBING_IP_BLOCKLIST file configured on the server is ever read; parsing a large
+        # feed is expensive, so only admins may trigger it
+        try:
+            ranges = reload_ip_blocklist()
+        except OSError:
+            return jsonify({"message": "Could not read the blocklist file"}), 500
+        except ValueError as e:
+            return jsonify({"message": f"Could not reload blocklist: {str(e)}"}), 400
+        return jsonify({"message": "Blocklist reloaded", "ranges": ranges}), 200
+
+    @app.route('/api/customers/events', methods=['POST'])
+    @admin_only
+    def customer_events_route():
+        # Body is one event or {"events": [...]}, see CustomerFeatureStore.record. Events override the
+        # wardrobing features of userData, so only the order system may send them: see admin_only
+        body = request.get_json(silent=True) or {}
+        events = body.get("events", [body])
+        if not isinstance(events, list):
+            return jsonify({"message": "Expected an event or an 'events' list"}), 400
+        try:
+            recorded = feature_store.record_many(events)
+        except (AttributeError, TypeError, ValueError) as e:
+            return jsonify({"message": f"Invalid event: {str(e)}"}), 400
+        return jsonify({"message": "Events recorded", "recorded": recorded}), 200
+
+    @app.route('/api/customers/<customer>/features', methods=['GET'])
+    @admin_only
+    def customer_features_route(customer):
+        features = feature_store.features(customer)
+        if features is None:
+            return jsonify({"message": "No events recorded for this customer"}), 404
+        return jsonify(features), 200
+
     @app.route('/api/data', methods=['POST'])
     def condition_grading_route():
+        mode = request.args.get('mode', 'sync')
+        # ?timings=1 adds a per-stage breakdown in milliseconds to the response
+        timings = RESPONSE_TIMINGS or request.args.get('timings') == '1'
+
+        def respond(body, status):
+            REQUESTS.inc(mode=mode, status=status)
+            return jsonify(body), status
+
+        if mode == 'async' and not ASYNC_JOBS:
+            return respond({"message": "mode=async is not available on this server, use mode=sync or mode=stream"},
+                           400)
+
         try:
-            # Get the price from the request (default to "100" if not provided)
-            price = request.form.get('price', '100')
-            
-            # Correctly extract userData
-            if request.is_json:
-                userData = request.get_json().get('userData', {})
-            else:
-                userData = request.form.get('userData', '{}')  # Default to empty JSON string if missing
+            price, userData, photo_bytes = parse_return_request()
+            log(f'Received photos: {len(photo_bytes)}', photos=len(photo_bytes))
+            log(f'Received price: {price}', price=price)
+
+            # ?mode=async queues the return and answers straight away with a job to poll
+            if mode == 'async':
                 try:
-                    userData = json.loads(userData)  # Convert string to dictionary
-                except json.JSONDecodeError:
-                    return jsonify({"message": "Invalid JSON in userData"}), 400
-
-            saved_photos = []
-            encoded_images = []
-
-            # Check if 'photos' part is present in the request
-            if 'photos' not in request.files:
-                return jsonify({"message": "No photos part in the request"}), 400
-
-            photos = request.files.getlist('photos')
-            filenames = []
-            # Save the photos
-            for index, photo in enumerate(photos):
-                if photo and allowed_file(photo.filename):
-                    filename = f"photo_{index + 1}.jpg"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    filenames.append(filepath)
-                    photo.save(filepath)
-                    saved_photos.append(filepath)
-
-            
-            detect_defects(model_dict, filenames, "")
-            print('Received photos:', saved_photos)
-            print('Received price:', price)
-
-            for index, photo in enumerate(photos):
-                with open(filenames[index], "rb") as img_file:
-                    img_data = img_file.read()
-                    encoded_img = base64.b64encode(img_data).decode('utf-8')
-                    # Just add the raw encoded image string to the array
-                    encoded_images.append(encoded_img)
-
-
-            # Ensure all results are JSON serializable by converting NumPy types
-            grading_result = int(condition_grading(price)) if isinstance(condition_grading(price), np.integer) else condition_grading(price)
-            action_result = int(recommended_action(price)) if isinstance(recommended_action(price), np.integer) else recommended_action(price)
-            repair_result = recommended_repair()  # Assuming this is already JSON safe
-            wardrobing_result = is_wardrobe(userData)
-
-            # Return the grading results, recommended action, and recommended repair as a response
-            return jsonify({
-                "message": "Data received and photos uploaded successfully!",
-                "images": encoded_images,
-                "grading_result": grading_result,
-                "recommended_action": action_result,
-                "recommended_repair": repair_result,
-                "wardrobing_result": wardrobing_result
-            }), 200
+                    job_id = job_manager.submit(run_return_pipeline, photo_bytes, price, userData, registry.models(),
+                                                assessment_engine, result_cache, image_store=image_store,
+                                                photo_index=photo_index, feature_store=feature_store,
+                                                timings=timings)
+                except QueueFullError as e:
+                    return respond({"message": str(e)}, 503)
+                return respond({"job_id": job_id, "status_url": f"/api/jobs/{job_id}"}, 202)
+
+            # ?mode=stream sends each stage's result as soon as it is ready, as NDJSON or
+            # server-sent events when the client accepts text/event-stream
+            if mode == 'stream':
+                sse = request.accept_mimetypes.best == 'text/event-stream'
+                models = registry.models()
+
+                def generate():
+                    try:
+                        with timed("request", mode):
+                            events = iter_return_pipeline(photo_bytes, price, userData, models,
+                                                          assessment_engine, result_cache, image_store=image_store,
+                                                          photo_index=photo_index, feature_store=feature_store)
+                            if timings:
+                                events = track_timings(events)
+                            if TRACE_MEMORY:
+                                events = track_memory(events)
+                            for stage, result in events:
+                                yield format_event(stage, result, sse)
+                        yield format_event("complete", {"message": "Data received and photos uploaded successfully!"}, sse)
+                    except Exception as e:
+                        log(f"Error processing the request: {e}", level=logging.ERROR, mode=mode, error=str(e))
+                        yield format_event("error", {"message": f"Error processing the data: {str(e)}"}, sse)
+
+                REQUESTS.inc(mode=mode, status=200)
+                mimetype = 'text/event-stream' if sse else 'application/x-ndjson'
+                return Response(stream_with_context(generate()), mimetype=mimetype)
+
+            with timed("request", mode):
+                response = run_return_pipeline(photo_bytes, price, userData, registry.models(), assessment_engine,
+                                               result_cache, image_store=image_store, timings=timings,
+                                               photo_index=photo_index, feature_store=feature_store)
+            return respond(response, 200)
 
+        except RequestError as e:
+            return respond({"message": str(e)}, 400)
+        except ModelsNotReadyError as e:
+            return respond({"message": str(e)}, 503)
         except Exception as e:
-            print(f"Error processing the request: {e}")
-            return jsonify({"message": f"Error processing the data: {str(e)}"}), 500
+            log(f"Error processing the request: {e}", level=logging.ERROR, mode=mode, error=str(e))
+            return respond({"message": f"Error processing the data: {str(e)}"}, 500)
+
+    @app.route('/api/inspect', methods=['POST'])
+    def inspect_route():
+        # A 'video' file, or an ordered sequence of 'frames' images; ?skip= and ?min_hits= tune the inspection.
+        # Each new defect is streamed as NDJSON once it is confirmed, followed by a report with the sustained FPS.
+        frame_skip = max(0, request.args.get('skip', 0, type=int))
+        min_hits = max(1, request.args.get('min_hits', 2, type=int))
+        try:
+            models = registry.models()
+        except ModelsNotReadyError as e:
+            return jsonify({"message": str(e)}), 503
+
+        video_path = None
+        if 'video' in request.files:
+            # OpenCV only reads videos from a file, so the upload is spooled to a temporary one
+            upload = request.files['video']
+            handle, video_path = tempfile.mkstemp(suffix=os.path.splitext(upload.filename or "")[1] or ".mp4")
+            with os.fdopen(handle, "wb") as video_file:
+                upload.save(video_file)
+            source = video_path
+        elif 'frames' in request.files:
+            frames = [frame.read() for frame in request.files.getlist('frames')]
+            source = (decode_upload(data, 0)[0] for data in frames)
+        else:
+            return jsonify({"message": "Expected a 'video' file or 'frames' images"}), 400
+
+        inspector = StreamInspector(models, source, frame_skip=frame_skip, tracker=IoUTracker(min_hits=min_hits))
+
+        def generate():
+            try:
+                for stage, result in inspector.iter_events():
+                    yield format_event(stage, result)
+            except Exception as e:
+                log(f"Error inspecting the stream: {e}", level=logging.ERROR, error=str(e))
+                yield format_event("error", {"message": f"Error inspecting the stream: {str(e)}"})
 
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        if video_path is not None:
+            # Runs even when the client goes away before the body is iterated
+            response.call_on_close(lambda: os.remove(video_path))
+        return response
 
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def get_job(job_id):
+        job = job_manager.get(job_id)
+        if job is None:
+            return jsonify({"message": "Job not found or expired"}), 404
+        return jsonify(job), 200
 
-# Initialize the Flask app
-app = Flask(__name__)
-init_routes(app)
 
 if __name__ == '__main__':
+    # Initialize the Flask app
+    app = Flask(__name__)
+    init_routes(app)
     app.run(debug=True, host='10.0.0.172', port = 5000)
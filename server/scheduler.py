@@ -0,0 +1,157 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from metrics import BATCH_QUEUE_DEPTH, BATCH_SIZE, BATCH_WAIT_SECONDS
+
+# Images batched into one forward across concurrent requests; 1 runs every request on its own
+MAX_BATCH = int(os.environ.get("GOODTOGO_BATCH_MAX_SIZE", "1"))
+# How long the first request of a batch waits for others to join it
+MAX_WAIT = float(os.environ.get("GOODTOGO_BATCH_MAX_WAIT_MS", "5")) / 1000
+
+
+class _Request:
+    __slots__ = ("blob", "future", "enqueued")
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class BatchScheduler:
+    """
+    Batches forwards from concurrent requests into one forward of the wrapped model.
+
+    Each forward call queues its blob and waits on a future. A dispatcher collects
+    queued blobs until max_batch images are waiting or max_wait has passed since the
+    oldest one arrived, runs them as one batch and hands every caller its own rows of
+    the output. Under load this trades up to max_wait of latency for fuller batches;
+    a lone request waits at most max_wait. Blobs of max_batch images or more skip the queue.
+
+    There is one dispatcher per instance of the wrapped ModelPool, so one batch can be
+    collected while others run. Dispatchers start with the first forward, in the process
+    that makes it, so a scheduler created before a pre-fork server forks still works in
+    each child. Attributes such as version are read through from the wrapped model.
+
+    Args:
+        model (ModelPool): Model to run, or any object with the backends' forward contract.
+        max_batch (int): Most images in one batch.
+        max_wait (float): Seconds the oldest queued request waits for a batch to fill.
+        name (str): Model name used as the metrics label.
+    """
+
+    def __init__(self, model, max_batch=MAX_BATCH, max_wait=MAX_WAIT, name=""):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self.dispatchers = getattr(model, "size", 1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._collect_lock = threading.Lock()
+        self._held = None  # request taken off the queue that did not fit in the previous batch
+        self._threads = []
+        self._pid = None
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _start_dispatchers(self):
+        # Called with self._lock held
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._threads = []
+        for index in range(self.dispatchers):
+            thread = threading.Thread(target=self._dispatch, name=f"batch-{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def forward(self, blob):
+        """
+        Runs a batch blob as part of a larger batch, same contract as the backends' forward.
+        """
+        if len(blob) >= self.max_batch:
+            return self.model.forward(blob)
+        request = _Request(blob)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._start_dispatchers()
+                self._queue.put(request)
+        if closed:
+            return self.model.forward(blob)
+        BATCH_QUEUE_DEPTH.set(self._queue.qsize(), model=self.name)
+        return request.future.result()
+
+    def _collect(self):
+        """
+        Takes the next batch off the queue; returns it and whether this dispatcher should stop.
+        """
+        first = self._held or self._queue.get()
+        self._held = None
+        if first is None:
+            return [], True
+        batch = [first]
+        images = len(first.blob)
+        deadline = first.enqueued + self.max_wait
+        while images < self.max_batch:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            if images + len(request.blob) > self.max_batch:
+                self._held = request
+                break
+            batch.append(request)
+            images += len(request.blob)
+        return batch, False
+
+    def _dispatch(self):
+        while True:
+            # One dispatcher collects at a time, so concurrent requests land in the same batch
+            with self._collect_lock:
+                batch, stop = self._collect()
+            BATCH_QUEUE_DEPTH.set(self._queue.qsize(), model=self.name)
+            if batch:
+                self._run(batch)
+            if stop:
+                return
+
+    def _run(self, batch):
+        started = time.perf_counter()
+        for request in batch:
+            BATCH_WAIT_SECONDS.observe(started - request.enqueued, model=self.name)
+        blob = batch[0].blob if len(batch) == 1 else np.concatenate([request.blob for request in batch])
+        BATCH_SIZE.observe(len(blob), model=self.name)
+        try:
+            outputs = self.model.forward(blob)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        offset = 0
+        for request in batch:
+            request.future.set_result(outputs[offset:offset + len(request.blob)])
+            offset += len(request.blob)
+
+    def close(self):
+        """
+        Stops the dispatchers once the requests already queued have run.
+
+        Forwards made afterwards run directly on the wrapped model, so requests still
+        holding a replaced scheduler keep working.
+        """
+        with self._lock:
+            self._closed = True
+            if self._pid == os.getpid():
+                for _ in self._threads:
+                    self._queue.put(None)
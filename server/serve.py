@@ -0,0 +1,314 @@
+import argparse
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+from backends import set_inference_threads
+from metrics import log
+from wardrobing import load_model
+
+# Worker processes forked from the master; each serves requests on its own threads
+WORKERS = int(os.environ.get("GOODTOGO_WORKERS", str(os.cpu_count() or 2)))
+# Inference threads per worker; keep workers x threads at or below the CPU count
+WORKER_THREADS = int(os.environ.get("GOODTOGO_WORKER_THREADS", "0")) or max(1, (os.cpu_count() or 2) // WORKERS)
+# A worker is recycled after this many requests (plus up to 10% jitter) or seconds; 0 disables either
+MAX_REQUESTS = int(os.environ.get("GOODTOGO_WORKER_MAX_REQUESTS", "1000"))
+MAX_AGE = float(os.environ.get("GOODTOGO_WORKER_MAX_AGE", "0"))
+# How long a stopping worker may take to finish its in-flight requests before it is killed
+GRACEFUL_TIMEOUT = float(os.environ.get("GOODTOGO_GRACEFUL_TIMEOUT", "30"))
+# Folder for the stores workers must share when they are not configured explicitly
+STATE_DIR = os.environ.get("GOODTOGO_STATE_DIR", "serverState")
+# Stores each worker would otherwise keep in its own memory, and where they go under STATE_DIR
+SHARED_STORES = {
+    "GOODTOGO_CACHE_DIR": "cache",
+    "GOODTOGO_IMAGE_DIR": "images",
+    "GOODTOGO_PHOTO_INDEX": "photo_index.sqlite3",
+    "GOODTOGO_FEATURE_STORE": "customer_features.sqlite3",
+}
+
+
+def configure_shared_state(state_dir=STATE_DIR):
+    """
+    Points every per-process store at disk so all workers see the same data.
+
+    Any request can land on any worker, so annotated images, cached results, the
+    photo index and customer features are kept in files under state_dir unless their
+    variable already names a location. Async jobs live in the memory of the worker
+    that runs them and cannot be polled through another one, so ?mode=async is
+    turned off. Must run before the app is imported.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    for variable, name in SHARED_STORES.items():
+        if os.environ.get(variable, ":memory:") == ":memory:":
+            os.environ[variable] = os.path.join(state_dir, name)
+        log(f"{variable}={os.environ[variable]}", variable=variable, path=os.environ[variable])
+    os.environ["GOODTOGO_ASYNC_JOBS"] = "0"
+
+
+class _RequestTracker:
+    """
+    WSGI middleware counting handled and in-flight requests of a worker.
+
+    A request stays in flight until its response body is closed, so streamed
+    responses are drained before the worker exits.
+    """
+
+    def __init__(self, app, max_requests, retire):
+        self.app = app
+        self.max_requests = max_requests
+        self.retire = retire
+        self.handled = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.handled += 1
+            self.in_flight += 1
+            if self.max_requests and self.handled >= self.max_requests:
+                self.retire.set()
+        try:
+            return _TrackedBody(self.app(environ, start_response), self._done)
+        except Exception:
+            self._done()
+            raise
+
+    def _done(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._idle.notify_all()
+
+    def wait_idle(self, timeout):
+        with self._lock:
+            return self._idle.wait_for(lambda: self.in_flight == 0, timeout)
+
+
+class _TrackedBody:
+    def __init__(self, body, done):
+        self.body = body
+        self.done = done
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.done()
+
+
+def run_worker(app, listener, threads, max_requests=MAX_REQUESTS, max_age=MAX_AGE,
+               graceful_timeout=GRACEFUL_TIMEOUT):
+    """
+    Serves app on an inherited listening socket until the worker is told to stop or retires.
+
+    Runs in a forked child. SIGTERM, max_requests or max_age stop it from accepting
+    new connections; it then waits up to graceful_timeout for in-flight requests and
+    exits, and the master starts a replacement.
+    """
+    from werkzeug.serving import make_server
+
+    retire = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: retire.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master handles Ctrl-C for the whole group
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    set_inference_threads(threads)
+
+    if max_requests:
+        # Jitter keeps workers started together from all recycling at once
+        max_requests += random.randint(0, max(1, max_requests // 10))
+    tracker = _RequestTracker(app, max_requests, retire)
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, tracker, threaded=True, fd=listener.fileno())
+
+    def stop_when_retired():
+        retire.wait(max_age or None)
+        server.shutdown()
+
+    threading.Thread(target=stop_when_retired, name="worker-retire", daemon=True).start()
+    log(f"Worker {os.getpid()} serving with {threads} inference threads", worker=os.getpid(), threads=threads)
+    server.serve_forever()
+    if not tracker.wait_idle(graceful_timeout):
+        log(f"Worker {os.getpid()} exiting with {tracker.in_flight} requests still in flight",
+            level=logging.WARNING, worker=os.getpid(), in_flight=tracker.in_flight)
+    log(f"Worker {os.getpid()} exiting after {tracker.handled} requests", worker=os.getpid(),
+        handled=tracker.handled)
+
+
+class PreforkServer:
+    """
+    Loads the app once and serves it from forked worker processes.
+
+    The detectors and the wardrobing model are loaded and warmed up in the master
+    before any worker exists, so workers share those pages copy-on-write instead of
+    each holding a copy. Garbage collection is frozen before forking so reference
+    counting does not dirty the shared pages. cv2.dnn networks are shared this way;
+    onnxruntime sessions cannot cross a fork and are reopened in each worker on
+    first use.
+
+    Workers share no memory after the fork, so the app must be built after
+    configure_shared_state: images, caches, the photo index and customer features
+    go through disk, and ?mode=async is refused because its jobs could only be
+    polled on the worker that ran them. Metrics are per worker.
+
+    SIGHUP reloads changed model files in the master and then replaces workers one
+    at a time. SIGTERM or SIGINT stop every worker gracefully.
+
+    Args:
+        app (flask.Flask): App built by init_routes, with its models already loaded.
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        workers (int): Worker processes to keep running.
+        threads (int): Inference threads per worker.
+        max_requests (int): Requests after which a worker is recycled, 0 for never.
+        max_age (float): Seconds after which a worker is recycled, 0 for never.
+        graceful_timeout (float): Seconds a stopping worker gets before it is killed.
+    """
+
+    def __init__(self, app, host="0.0.0.0", port=5000, workers=WORKERS, threads=WORKER_THREADS,
+                 max_requests=MAX_REQUESTS, max_age=MAX_AGE, graceful_timeout=GRACEFUL_TIMEOUT):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_age = max_age
+        self.graceful_timeout = graceful_timeout
+        self._children = {}  # pid to the time it was asked to stop, or None while serving
+        self._stopping = False
+        self._reload = False
+
+    def _spawn(self, listener):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app, listener, self.threads, self.max_requests, self.max_age,
+                           self.graceful_timeout)
+            except BaseException as error:
+                log(f"Worker {os.getpid()} failed: {error}", level=logging.ERROR, worker=os.getpid())
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self._children[pid] = None
+
+    def _stop_child(self, pid):
+        if pid in self._children and self._children[pid] is None:
+            self._children[pid] = time.monotonic()
+            self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if pid == 0:
+                return
+            asked_to_stop = self._children.pop(pid, None) is not None
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0 and not asked_to_stop:
+                log(f"Worker {pid} exited with code {code}", level=logging.WARNING, worker=pid, code=code)
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        for pid, stopped_at in list(self._children.items()):
+            if stopped_at is not None and now - stopped_at > self.graceful_timeout + 5:
+                log(f"Killing worker {pid}, it did not stop in time", level=logging.WARNING, worker=pid)
+                self._signal(pid, signal.SIGKILL)
+
+    def _reload_models(self):
+        registry = self.app.extensions.get("goodtogo", {}).get("registry")
+        if registry is not None:
+            registry.reload_changed()
+        load_model()
+        gc.freeze()
+
+    def run(self):
+        listener = socket.create_server((self.host, self.port), backlog=1024)
+        load_model()
+        # Objects loaded so far stay out of the collector, which would otherwise touch their pages
+        gc.freeze()
+
+        def request_stop(signum, frame):
+            self._stopping = True
+
+        def request_reload(signum, frame):
+            self._reload = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGHUP, request_reload)
+        log(f"Serving on {self.host}:{self.port} with {self.workers} workers of {self.threads} inference threads",
+            host=self.host, port=self.port, workers=self.workers, threads=self.threads)
+
+        retiring = []
+        while not self._stopping:
+            self._reap()
+            if self._reload:
+                self._reload = False
+                log("Reloading models and recycling workers")
+                self._reload_models()
+                retiring = [pid for pid, stopped_at in self._children.items() if stopped_at is None]
+            serving = [pid for pid, stopped_at in self._children.items() if stopped_at is None]
+            for _ in range(self.workers - len(serving)):
+                self._spawn(listener)
+            # Rolling restart: the next worker is stopped once the previous one has been replaced
+            retiring = [pid for pid in retiring if pid in self._children]
+            if retiring and all(stopped_at is None for stopped_at in self._children.values()):
+                self._stop_child(retiring.pop(0))
+            self._kill_overdue()
+            time.sleep(0.2)
+
+        log("Stopping workers")
+        for pid in list(self._children):
+            self._stop_child(pid)
+        while self._children:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.1)
+        listener.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the API from pre-forked worker processes.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS, help="Inference threads per worker.")
+    parser.add_argument("--max-requests", type=int, default=MAX_REQUESTS)
+    parser.add_argument("--max-age", type=float, default=MAX_AGE)
+    parser.add_argument("--graceful-timeout", type=float, default=GRACEFUL_TIMEOUT)
+    parser.add_argument("--state-dir", default=STATE_DIR, help="Folder for stores shared between workers.")
+    args = parser.parse_args()
+
+    configure_shared_state(args.state_dir)
+
+    # Models must be fully loaded before forking and stay fixed in the workers; reloads go through SIGHUP
+    os.environ["GOODTOGO_LAZY_MODELS"] = "0"
+    os.environ["GOODTOGO_MODEL_WATCH_INTERVAL"] = "0"
+    # Warm-up in the master runs single-threaded so no inference thread pools exist when forking
+    set_inference_threads(1)
+    from app import app
+
+    PreforkServer(app, args.host, args.port, args.workers, args.threads, args.max_requests, args.max_age,
+                  args.graceful_timeout).run()
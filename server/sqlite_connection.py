@@ -0,0 +1,36 @@
+import os
+import sqlite3
+
+
+class SQLiteConnection:
+    """
+    An SQLite connection that each process opens for itself.
+
+    SQLite connections must not be used across a fork, so a process that inherits
+    this object (such as a pre-forked worker) opens a fresh connection on first use.
+    Callers serialize access with their own lock.
+
+    Args:
+        path (str): Database file, or ":memory:".
+        setup (callable): Called with every new connection, e.g. to create tables.
+    """
+
+    def __init__(self, path, setup=None):
+        self.path = path
+        self.setup = setup
+        self._db = None
+        self._pid = None
+        self.get()
+
+    def get(self):
+        """
+        Returns this process's connection, opening it if needed.
+        """
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            self._pid = os.getpid()
+            self._db.execute("PRAGMA journal_mode=WAL")
+            if self.setup is not None:
+                self.setup(self._db)
+                self._db.commit()
+        return self._db
@@ -1,13 +1,19 @@
+import argparse
+import logging
+import os
 import random
+import threading
+import time
 import numpy as np
 import pandas as pd
-from faker import Faker
+import joblib
+import sklearn
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
 import ipaddress
-
-fake = Faker()
+from ip_risk import load_index
+from metrics import log
 
 HIGH_RISK_IP_RANGES = [
     ("192.168.1.0", "192.168.1.255"),  # Example local network
@@ -15,19 +21,28 @@ HIGH_RISK_IP_RANGES = [
     ("45.134.56.0", "45.134.56.255"),  # Example suspicious IP block
 ]
 
+FEATURE_COLUMNS = ["amount", "is_high_risk_ip", "num_failed_attempts", "return_rate", "payment_method"]
+PAYMENT_METHODS = {"credit_card": 0, "paypal": 1, "crypto": 2}
+MODEL_PATH = os.environ.get("WARDROBING_MODEL_PATH", "wardrobingResources/wardrobing_model.joblib")
+
 def random_ip():
     return str(ipaddress.IPv4Address(random.randint(0, 2**32 - 1)))
 
+# Built once; set WARDROBING_IP_BLOCKLIST to a file of CIDRs/ranges to use a real feed
+ip_risk_index = load_index(HIGH_RISK_IP_RANGES)
+
 def is_high_risk_ip(ip):
-    ip_obj = ipaddress.IPv4Address(ip)
-    for start, end in HIGH_RISK_IP_RANGES:
-        if ipaddress.IPv4Address(start) <= ip_obj <= ipaddress.IPv4Address(end):
-            return 1  # High risk
-    return 0  # Low risk
+    return 1 if ip_risk_index.contains(ip) else 0  # 1 = high risk
+
+def reload_ip_blocklist():
+    """
+    Re-reads the WARDROBING_IP_BLOCKLIST file without a restart and returns the number of ranges.
+    """
+    ip_risk_index.reload()
+    return len(ip_risk_index)
 
 def preprocess_user_data(user_data):
-    payment_method_map = {"credit_card": 0, "paypal": 1, "crypto": 2}  # Default mapping
-    payment_method = payment_method_map.get(user_data.get("payment_method", "credit_card"), 0)  # Default to credit_card
+    payment_method = PAYMENT_METHODS.get(user_data.get("payment_method", "credit_card"), 0)  # Default to credit_card
 
     return_rate = (user_data['productsReturned'] * user_data['amountReturned']) / (user_data['productsBought'] * user_data['amountBought']) if (user_data['productsBought'] > 0 and user_data['amountBought'] > 0) else 0
     is_high_risk_ip_flag = is_high_risk_ip(user_data["ip"])
@@ -65,19 +80,186 @@ def generate_mock_data(num_samples=1000, noise_level=0.1):
 
     return pd.DataFrame(data, columns=["ip", "amount", "is_high_risk_ip", "num_failed_attempts", "return_rate", "payment_method", "is_fraud"])
 
-df = generate_mock_data()
-df["payment_method"] = df["payment_method"].map({"credit_card": 0, "paypal": 1, "crypto": 2})
+def ipv4_to_str(values):
+    """
+    Formats an array of IPv4 integers as dotted-quad strings without a per-row Python loop.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    octets = [pd.Series((values >> shift) & 255).astype(str) for shift in (24, 16, 8, 0)]
+    return octets[0] + "." + octets[1] + "." + octets[2] + "." + octets[3]
+
+def iter_mock_data(num_samples=1000, chunk_size=100_000, noise_level=0.1, seed=None, include_ip=True):
+    """
+    Vectorized version of generate_mock_data that yields the rows in chunks.
+
+    Uses the same distributions, fraud rule and 5% label flipping as generate_mock_data,
+    but draws each column with one NumPy call, so tens of millions of rows can be
+    streamed to disk without holding them all in memory.
+
+    Args:
+        num_samples (int): Total number of rows.
+        chunk_size (int): Rows per yielded DataFrame.
+        noise_level (float): Relative standard deviation of the noise on amount and return rate.
+        seed (int): Seed for reproducible data.
+        include_ip (bool): Add the "ip" string column, which is the slowest one to build.
+
+    Yields:
+        pandas.DataFrame: Chunks with the columns of generate_mock_data.
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_samples, chunk_size):
+        n = min(chunk_size, num_samples - start)
+
+        ip = rng.integers(0, 2**32, size=n, dtype=np.int64)
+        amount = np.round(rng.uniform(5, 2000, size=n), 2)
+        amount += rng.normal(0, noise_level * amount)  # Adding noise
+
+        is_high_risk_ip_flag = ip_risk_index.lookup_ipv4_ints(ip).astype(np.int64)
+        num_failed_attempts = rng.integers(0, 6, size=n) + rng.integers(-1, 2, size=n)  # Small random error
+
+        return_rate = np.round(rng.uniform(0, 1, size=n), 2)
+        return_rate += rng.normal(0, noise_level * return_rate)  # Adding noise
+
+        payment_method = rng.choice(np.array(["credit_card", "paypal", "crypto"]), size=n)
+
+        # Fraud logic with noise
+        is_fraud = ((amount > 1000) | (num_failed_attempts > 3) | (return_rate > 0.7)
+                    | (is_high_risk_ip_flag == 1)).astype(np.int64)
+        flip = rng.random(n) < 0.05  # Introduce 5% label flipping noise
+        is_fraud[flip] = 1 - is_fraud[flip]
+
+        chunk = pd.DataFrame({
+            "amount": amount,
+            "is_high_risk_ip": is_high_risk_ip_flag,
+            "num_failed_attempts": num_failed_attempts,
+            "return_rate": return_rate,
+            "payment_method": payment_method,
+            "is_fraud": is_fraud,
+        })
+        if include_ip:
+            chunk.insert(0, "ip", ipv4_to_str(ip))
+        yield chunk
+
+def write_mock_data(path, num_samples, chunk_size=1_000_000, noise_level=0.1, seed=None, include_ip=True):
+    """
+    Streams synthetic rows to a Parquet (needs pyarrow) or CSV file, one chunk at a time.
+
+    Returns:
+        int: Number of rows written.
+    """
+    chunks = iter_mock_data(num_samples, chunk_size, noise_level, seed, include_ip)
+    written = 0
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing Parquet needs pyarrow; pip install pyarrow or use a .csv path")
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                written += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        for index, chunk in enumerate(chunks):
+            chunk.to_csv(path, mode="w" if index == 0 else "a", header=index == 0, index=False)
+            written += len(chunk)
+    return written
+
+def train_model(output_path=MODEL_PATH, num_samples=1000, seed=42):
+    """
+    Trains the wardrobing classifier on mock data and saves it as a versioned artifact.
+
+    Args:
+        output_path (str): Where to write the joblib artifact.
+        num_samples (int): Number of mock rows to generate.
+        seed (int): Seed for the mock data, so the same call always produces the same model.
+
+    Returns:
+        dict: The saved artifact (model plus metadata).
+    """
+    df = next(iter_mock_data(num_samples, chunk_size=max(num_samples, 1), seed=seed, include_ip=False))
+    df["payment_method"] = df["payment_method"].map(PAYMENT_METHODS)
+
+    X = df[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+    y = df["is_fraud"].to_numpy()
 
-X = df.drop(columns=["is_fraud", "ip"])
-y = df["is_fraud"]
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    model = RandomForestClassifier(n_estimators=100, random_state=42)
+    model.fit(X_train, y_train)
 
-model = RandomForestClassifier(n_estimators=100, random_state=42)
-model.fit(X_train, y_train)
+    accuracy = accuracy_score(y_test, model.predict(X_test))
+    log(f"Model Accuracy: {accuracy * 100:.2f}%", accuracy=accuracy)
 
-y_pred = model.predict(X_test)
-print(f"Model Accuracy: {accuracy_score(y_test, y_pred) * 100:.2f}%")
+    trained_at = time.time()
+    artifact = {
+        "model": model,
+        "version": time.strftime("%Y%m%d-%H%M%S", time.gmtime(trained_at)),
+        "features": FEATURE_COLUMNS,
+        "payment_methods": PAYMENT_METHODS,
+        "trained_at": trained_at,
+        "num_samples": num_samples,
+        "seed": seed,
+        "accuracy": accuracy,
+        "sklearn_version": sklearn.__version__,
+    }
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    # Write next to the target and rename, so workers never load a half-written file
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    joblib.dump(artifact, temp_path)
+    os.replace(temp_path, output_path)
+    return artifact
+
+_artifact = None
+_artifact_mtime = None
+_artifact_missing = False
+_artifact_lock = threading.Lock()
+
+def load_model(path=MODEL_PATH):
+    """
+    Returns the wardrobing artifact, loading it on first use.
+
+    Tree ensembles copy their node arrays into process memory when unpickled, so the
+    file is not memory-mapped; workers of serve.py share the model copy-on-write because
+    the master loads it before forking. It is reloaded when the file changes on disk, so
+    a retrained model can be dropped in without a restart. If no artifact exists at
+    startup, one is trained and saved. If the file disappears later, the loaded model
+    keeps serving; requests never retrain it, that is left to train_model.
+    """
+    global _artifact, _artifact_mtime, _artifact_missing
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+
+    if _artifact is not None and mtime == _artifact_mtime:
+        return _artifact
+    if _artifact is not None and mtime is None:
+        if not _artifact_missing:
+            _artifact_missing = True
+            log(f"Wardrobing model {path} is gone, keeping version {_artifact['version']}", level=logging.WARNING,
+                path=path, version=_artifact['version'])
+        return _artifact
+
+    with _artifact_lock:
+        if _artifact is None or mtime != _artifact_mtime:
+            if mtime is None:
+                log(f"No wardrobing model at {path}, training one", path=path)
+                train_model(path)
+                mtime = os.path.getmtime(path)
+            _artifact = joblib.load(path)
+            _artifact_mtime = mtime
+            _artifact_missing = False
+            log(f"Loaded wardrobing model version {_artifact['version']}", version=_artifact['version'])
+    return _artifact
 
 userData = {
     "name": "John Doe",
@@ -90,7 +272,97 @@ userData = {
     "numFailedAttempts": 0,
 }
 
-def is_wardrobe(user_data):
+def is_wardrobe(user_data, feature_store=None):
+    """
+    Predicts whether a return is wardrobing (1) or not (0).
+
+    Args:
+        user_data (dict): Customer data, see preprocess_user_data.
+        feature_store (CustomerFeatureStore): When given, the purchase and return totals
+            recorded for the customer replace the ones sent in user_data.
+    """
+    model = load_model()["model"]
+    if feature_store is not None:
+        user_data = feature_store.merge(user_data)
     processed_data = preprocess_user_data(user_data)
-    print("predict:", int(model.predict(processed_data)[0]))
-    return int(model.predict(processed_data)[0])
\ No newline at end of file
+    prediction = int(model.predict(processed_data)[0])
+    log(f"predict: {prediction}", prediction=prediction)
+    return prediction
+
+def preprocess_users(records):
+    """
+    Builds the feature matrix for many users in one vectorized pass.
+
+    Args:
+        records: Either a list of userData dicts or a dict of equal-length columns
+            keyed by the same field names.
+
+    Returns:
+        numpy.ndarray: (N, len(FEATURE_COLUMNS)) matrix, rows in input order.
+    """
+    df = pd.DataFrame(records)
+    if df.empty:
+        return np.empty((0, len(FEATURE_COLUMNS)))
+
+    if "payment_method" in df:
+        payment_method = df["payment_method"].map(PAYMENT_METHODS).fillna(0).to_numpy()
+    else:
+        payment_method = np.zeros(len(df))
+
+    products_bought = df["productsBought"].to_numpy(dtype=np.float64)
+    amount_bought = df["amountBought"].to_numpy(dtype=np.float64)
+    amount_returned = df["amountReturned"].to_numpy(dtype=np.float64)
+    bought = products_bought * amount_bought
+    returned = df["productsReturned"].to_numpy(dtype=np.float64) * amount_returned
+    valid = (products_bought > 0) & (amount_bought > 0)
+    return_rate = np.divide(returned, bought, out=np.zeros(len(df)), where=valid)
+
+    ip_risk = ip_risk_index.lookup_many(df["ip"].astype(str)).astype(np.float64)
+
+    return np.column_stack([
+        amount_returned,
+        ip_risk,
+        df["numFailedAttempts"].to_numpy(dtype=np.float64),
+        return_rate,
+        payment_method,
+    ])
+
+def score_users(records):
+    """
+    Scores many users with a single predict_proba call.
+
+    Args:
+        records: List of userData dicts or a dict of columns, see preprocess_users.
+
+    Returns:
+        tuple: (predictions, fraud probabilities) as NumPy arrays in input order.
+    """
+    model = load_model()["model"]
+    features = preprocess_users(records)
+    if len(features) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    probabilities = model.predict_proba(features)
+    predictions = model.classes_[probabilities.argmax(axis=1)].astype(np.int64)
+    classes = list(model.classes_)
+    fraud_probability = probabilities[:, classes.index(1)] if 1 in classes else np.zeros(len(features))
+    return predictions, fraud_probability
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the wardrobing model or generate synthetic data.")
+    parser.add_argument("command", choices=["train", "generate"])
+    parser.add_argument("--output", default=None,
+                        help="Model artifact path for train, .parquet or .csv data file for generate.")
+    parser.add_argument("--samples", type=int, default=1000, help="Number of mock rows.")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000, help="Rows generated per chunk.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for the mock data.")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        output = args.output or MODEL_PATH
+        artifact = train_model(output, args.samples, args.seed)
+        print(f"Saved wardrobing model version {artifact['version']} to {output}")
+    else:
+        output = args.output or "mock_data.csv"
+        rows = write_mock_data(output, args.samples, args.chunk_size, seed=args.seed)
+        print(f"Wrote {rows} rows to {output}")
\ No newline at end of file
@@ -1,9 +1,14 @@
 import argparse
 import cv2
 import cv2.dnn
+import logging
 import numpy as np
 import os
 
+from backends import BACKENDS, ModelPool, load_backend, variant_path
+from cache import make_key
+from metrics import DETECTIONS, log, timed
+
 from ultralytics.utils import ASSETS, yaml_load
 from ultralytics.utils.checks import check_yaml
 
@@ -28,109 +33,576 @@ def draw_bounding_box(img, class_id, confidence, x, y, x_plus_w, y_plus_h, class
     colors = np.random.uniform(0, 255, size=(len(class_dict["model1"]), 3))  # Adjust color size to fit all class names
    
     label = f"{classes[class_id]} ({confidence:.2f})"
-    print(label)
+    log(label, level=logging.DEBUG, class_name=classes[class_id], confidence=round(confidence, 4))
     color = colors[class_id]
     cv2.rectangle(img, (x, y), (x_plus_w, y_plus_h), color, 10)
     cv2.putText(img, label, (x - 10, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 5, color, 10)
 
-def add_model(model_name: str, model_path: str, class_path: str):
+def add_model(model_name: str, model_path: str, class_path: str, backend: str = "cv2", instances: int = 1,
+              variant: str = "fp32", **options):
     """
     Loads a model and class names and stores them in the dictionaries.
+
+    Args:
+        model_name (str): Key the model is stored under.
+        model_path (str): Path to the ONNX weights.
+        class_path (str): Path to the YAML file listing class names.
+        backend (str): Inference backend, "cv2" or "onnxruntime".
+        instances (int): Number of independent copies kept so concurrent requests can run in parallel.
+        variant (str): "fp32", or a variant built next to model_path by quantize.py, e.g. "int8-static".
+        **options: Backend settings such as threads, intra_op_threads or graph_optimization.
     """
-    model_dict[model_name] = cv2.dnn.readNetFromONNX(model_path)
+    model_dict[model_name] = ModelPool(variant_path(model_path, variant), backend, instances, **options)
     class_dict[model_name] = yaml_load(check_yaml(class_path))["names"]
 
-def detect_defects(models, input_images, file_path):
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.45
+TOP_K = 300
+INPUT_SIZE = 640
+DRAW_THRESHOLD = 0.3
+# Tiled inference for small defects, see detect_tiled
+TILE_OVERLAP = 0.2
+TILE_MIN_TEXTURE = 2.0
+TILE_MAX = 24
+TILE_BATCH_SIZE = 8
+
+# One record per detection; boxes are (x1, y1, x2, y2) in model input pixels.
+DETECTION_DTYPE = np.dtype([
+    ("class_id", np.int32),
+    ("confidence", np.float32),
+    ("x1", np.float32),
+    ("y1", np.float32),
+    ("x2", np.float32),
+    ("y2", np.float32),
+])
+
+def non_max_suppression(boxes, scores, iou_threshold=IOU_THRESHOLD):
+    """
+    Greedy non-maximum suppression over xyxy boxes.
+
+    Args:
+        boxes (numpy.ndarray): (N, 4) array of x1, y1, x2, y2 boxes.
+        scores (numpy.ndarray): (N,) array of confidence scores.
+        iou_threshold (float): Boxes overlapping a kept box above this IoU are dropped.
+
+    Returns:
+        numpy.ndarray: Indices of the kept boxes, highest score first.
+    """
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    order = np.argsort(-scores, kind="stable")
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        # IoU of the kept box against every remaining candidate at once
+        w = np.maximum(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0)
+        h = np.maximum(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0)
+        inter = w * h
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        order = rest[iou <= iou_threshold]
+
+    return np.array(keep, dtype=np.intp)
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Pairwise IoU between two sets of xyxy boxes.
+
+    Args:
+        boxes_a (numpy.ndarray): (N, 4) array of x1, y1, x2, y2 boxes.
+        boxes_b (numpy.ndarray): (M, 4) array of x1, y1, x2, y2 boxes.
+
+    Returns:
+        numpy.ndarray: (N, M) array of IoU values.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    area_a = np.maximum(boxes_a[:, 2] - boxes_a[:, 0], 0) * np.maximum(boxes_a[:, 3] - boxes_a[:, 1], 0)
+    area_b = np.maximum(boxes_b[:, 2] - boxes_b[:, 0], 0) * np.maximum(boxes_b[:, 3] - boxes_b[:, 1], 0)
+    a, b = boxes_a[:, None, :], boxes_b[None, :, :]
+    w = np.maximum(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0)
+    h = np.maximum(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0)
+    inter = w * h
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+def detection_boxes(detections):
+    """
+    Returns the (N, 4) xyxy boxes of a DETECTION_DTYPE array.
+    """
+    return np.stack([detections["x1"], detections["y1"], detections["x2"], detections["y2"]], axis=1)
+
+def decode_outputs(output, conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD, top_k=TOP_K):
+    """
+    Decodes one raw YOLOv8 output tensor into detection records.
+
+    Args:
+        output (numpy.ndarray): Model output of shape (4 + num_classes, num_anchors) for a single image.
+        conf_threshold (float): Minimum class score for a box to be kept.
+        iou_threshold (float): IoU threshold used by non-maximum suppression.
+        top_k (int): Maximum number of detections returned (None for no cap).
+
+    Returns:
+        numpy.ndarray: Structured array of DETECTION_DTYPE sorted by confidence.
+    """
+    predictions = np.asarray(output, dtype=np.float32).T  # (num_anchors, 4 + num_classes)
+    class_scores = predictions[:, 4:]
+
+    class_ids = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(len(class_scores)), class_ids]
+
+    mask = scores >= conf_threshold
+    if not mask.any():
+        return np.empty(0, dtype=DETECTION_DTYPE)
+
+    xywh = predictions[mask, :4]
+    scores = scores[mask]
+    class_ids = class_ids[mask]
+
+    # Cap candidates before NMS so a noisy image cannot blow up the greedy loop
+    if top_k is not None and len(scores) > 4 * top_k:
+        candidates = np.argpartition(-scores, 4 * top_k)[:4 * top_k]
+        xywh, scores, class_ids = xywh[candidates], scores[candidates], class_ids[candidates]
+
+    boxes = np.empty_like(xywh)
+    boxes[:, :2] = xywh[:, :2] - 0.5 * xywh[:, 2:]
+    boxes[:, 2:] = xywh[:, :2] + 0.5 * xywh[:, 2:]
+
+    keep = non_max_suppression(boxes, scores, iou_threshold)
+    if top_k is not None:
+        keep = keep[:top_k]
+
+    detections = np.empty(len(keep), dtype=DETECTION_DTYPE)
+    detections["class_id"] = class_ids[keep]
+    detections["confidence"] = scores[keep]
+    detections["x1"], detections["y1"] = boxes[keep, 0], boxes[keep, 1]
+    detections["x2"], detections["y2"] = boxes[keep, 2], boxes[keep, 3]
+    return detections
+
+def letterbox(image, size=INPUT_SIZE):
+    """
+    Resizes an image straight onto a size x size canvas, keeping its aspect ratio.
+
+    The image sits in the top-left corner with black padding to the right or below,
+    the same layout the old full-resolution square canvas produced, but without
+    allocating a canvas the size of the original photo.
+
+    Args:
+        image (numpy.ndarray): BGR image of any size.
+        size (int): Model input size.
+
+    Returns:
+        tuple: (size x size BGR canvas, (x scale, y scale) mapping canvas pixels back to image pixels)
+    """
+    [height, width, _] = image.shape
+    ratio = size / max(height, width)
+    new_width = max(1, min(size, round(width * ratio)))
+    new_height = max(1, min(size, round(height * ratio)))
+
+    # INTER_AREA averages the pixels it drops, which keeps small defects visible when shrinking
+    interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+
+    canvas = np.zeros((size, size, 3), np.uint8)
+    canvas[:new_height, :new_width] = resized
+    return canvas, (width / new_width, height / new_height)
+
+def preprocess_images(images, size=INPUT_SIZE):
+    """
+    Letterboxes each image to the model input size and stacks them into a single NCHW blob.
+
+    Args:
+        images (list[numpy.ndarray]): BGR images of any size.
+        size (int): Model input size.
+
+    Returns:
+        tuple: (blob of shape (N, 3, size, size), (N, 2) array of per-image x/y scale factors)
+    """
+    canvases = []
+    scales = []
+    for original_image in images:
+        canvas, scale = letterbox(original_image, size)
+        canvases.append(canvas)
+        scales.append(scale)
+
+    blob = cv2.dnn.blobFromImages(canvases, scalefactor=1 / 255, size=(size, size), swapRB=True)
+    return blob, np.array(scales, dtype=np.float32)
+
+def detect_images(models, images, conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD, top_k=TOP_K,
+                  batch=True, cache=None, image_bytes=None, count=True):
+    """
+    Runs every model over in-memory images.
+
+    Args:
+        models (dict): Model name to ModelPool (or any backend), as filled in by add_model.
+        images (list[numpy.ndarray]): Decoded BGR images.
+        conf_threshold (float): Minimum class score for a detection.
+        iou_threshold (float): IoU threshold for non-maximum suppression.
+        top_k (int): Maximum number of detections kept per model and image.
+        batch (bool): Run all images through each model in one forward instead of one per image.
+        cache (ResultCache): Optional cache of detections keyed by image bytes, model version and thresholds.
+        image_bytes (list[bytes]): Encoded bytes of each image, used as the cache key. Without them
+            the decoded pixels are hashed instead.
+        count (bool): Add the results to goodtogo_detections_total; off when they are not final yet.
+
+    Returns:
+        list[dict]: One dict per image mapping model name to a DETECTION_DTYPE
+        array, with boxes scaled back to original image pixels.
+    """
+    if not images:
+        return []
+
+    results = [{} for _ in images]
+    cache_keys = []
+    if cache is not None:
+        for index, image in enumerate(images):
+            # The shape is part of the key because boxes are in decoded pixels, which depend on
+            # how far the upload was downscaled while decoding
+            content = (image.shape, image_bytes[index] if image_bytes is not None else image.tobytes())
+            keys = {
+                model_name: make_key("detections", content, model_name, getattr(model, "version", None),
+                                     conf_threshold, iou_threshold, top_k)
+                for model_name, model in models.items()
+            }
+            cache_keys.append(keys)
+            for model_name, key in keys.items():
+                cached = cache.get(key)
+                if cached is not None:
+                    results[index][model_name] = cached.copy()
+
+    # Only images with at least one model missing from the cache go through inference
+    pending = [index for index, detections in enumerate(results) if len(detections) < len(models)]
+    if pending:
+        # Preprocess every image once and share the blob between models
+        with timed("preprocess"):
+            blob, scales = preprocess_images([images[index] for index in pending])
+
+        for model_name, model in models.items():
+            rows = [row for row, index in enumerate(pending) if model_name not in results[index]]
+            if not rows:
+                continue
+            model_blob = blob if len(rows) == len(pending) else blob[rows]
+            with timed("forward", model_name):
+                if batch:
+                    outputs = model.forward(model_blob)
+                else:
+                    outputs = np.concatenate([model.forward(model_blob[i:i + 1]) for i in range(len(model_blob))])
+
+            for row, output in zip(rows, outputs):
+                index = pending[row]
+                with timed("nms", model_name):
+                    model_detections = decode_outputs(output, conf_threshold, iou_threshold, top_k)
+                scale_x, scale_y = scales[row]
+                model_detections["x1"] *= scale_x
+                model_detections["x2"] *= scale_x
+                model_detections["y1"] *= scale_y
+                model_detections["y2"] *= scale_y
+                results[index][model_name] = model_detections
+                if cache is not None:
+                    cache.set(cache_keys[index][model_name], model_detections.copy())
+
+    if count:
+        count_detections(results)
+    return results
+
+def count_detections(results):
+    """
+    Adds the detections returned for each image to goodtogo_detections_total.
+    """
+    for detections in results:
+        for model_name, model_detections in detections.items():
+            DETECTIONS.inc(len(model_detections), model=model_name)
+
+def tile_offsets(length, size=INPUT_SIZE, overlap=TILE_OVERLAP):
+    """
+    Start positions of overlapping tiles covering length pixels, the last one flush with the edge.
+    """
+    if length <= size:
+        return np.zeros(1, dtype=np.int64)
+    stride = size * (1 - overlap)
+    count = int(np.ceil((length - size) / stride)) + 1
+    return np.round(np.linspace(0, length - size, count)).astype(np.int64)
+
+def tile_texture(image, tiles, size=INPUT_SIZE):
+    """
+    Mean Laplacian magnitude of each tile, from one pass over a downscaled copy of the image.
+
+    The image is shrunk so each tile covers about 64 pixels, and an integral image of
+    the edge response gives every tile's mean with four lookups, so scoring costs
+    about the same however many tiles there are.
+
+    Args:
+        image (numpy.ndarray): BGR image.
+        tiles (numpy.ndarray): (N, 2) array of tile x, y offsets.
+        size (int): Tile size in image pixels.
+
+    Returns:
+        numpy.ndarray: (N,) texture score per tile; flat backgrounds score near 0.
+    """
+    [height, width, _] = image.shape
+    factor = min(1.0, 64 / size)
+    small = cv2.resize(image, (max(1, round(width * factor)), max(1, round(height * factor))),
+                       interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    edges = np.abs(cv2.Laplacian(gray, cv2.CV_32F))
+    integral = cv2.integral(edges, sdepth=cv2.CV_64F)
+
+    [small_height, small_width] = gray.shape
+    x1 = np.clip(np.round(tiles[:, 0] * factor).astype(np.int64), 0, small_width - 1)
+    y1 = np.clip(np.round(tiles[:, 1] * factor).astype(np.int64), 0, small_height - 1)
+    x2 = np.clip(np.round((tiles[:, 0] + size) * factor).astype(np.int64), x1 + 1, small_width)
+    y2 = np.clip(np.round((tiles[:, 1] + size) * factor).astype(np.int64), y1 + 1, small_height)
+    sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    return sums / ((x2 - x1) * (y2 - y1))
+
+def merge_detections(detections, iou_threshold=IOU_THRESHOLD, top_k=TOP_K):
+    """
+    Merges overlapping detections from several passes, e.g. neighbouring tiles, per class.
+
+    Boxes of different classes are shifted apart before one non-maximum suppression
+    run, so all classes are merged in a single vectorized pass.
+
+    Args:
+        detections (list[numpy.ndarray]): DETECTION_DTYPE arrays in the same pixel space.
+        iou_threshold (float): Boxes overlapping a kept box of the same class above this IoU are dropped.
+        top_k (int): Maximum number of detections kept (None for no cap).
+
+    Returns:
+        numpy.ndarray: Merged DETECTION_DTYPE array sorted by confidence.
+    """
+    merged = np.concatenate(detections) if detections else np.empty(0, dtype=DETECTION_DTYPE)
+    if len(merged) == 0:
+        return merged
+    boxes = detection_boxes(merged)
+    offset = (boxes.max() - boxes.min() + 1) * merged["class_id"][:, None]
+    keep = non_max_suppression(boxes + offset, merged["confidence"], iou_threshold)
+    if top_k is not None:
+        keep = keep[:top_k]
+    return merged[keep]
+
+def detect_tiled(models, images, conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD, top_k=TOP_K,
+                 tile_size=INPUT_SIZE, overlap=TILE_OVERLAP, min_texture=TILE_MIN_TEXTURE, max_tiles=TILE_MAX,
+                 batch_size=TILE_BATCH_SIZE, cache=None, image_bytes=None):
+    """
+    Runs every model over overlapping full-resolution tiles as well as the whole image.
+
+    Small defects that vanish when a photo is squashed to the model input survive in
+    a tile at native resolution, while the whole-image pass still finds defects larger
+    than a tile. Tiles of every image are stacked and sent through each model
+    batch_size at a time. Tiles without texture are skipped, and at most max_tiles of
+    the most textured ones are run per image, which bounds the cost on large photos.
+
+    Args:
+        models (dict): Model name to ModelPool (or any backend), as filled in by add_model.
+        images (list[numpy.ndarray]): Decoded BGR images.
+        conf_threshold (float): Minimum class score for a detection.
+        iou_threshold (float): IoU threshold for non-maximum suppression and for merging across seams.
+        top_k (int): Maximum number of detections kept per model and image.
+        tile_size (int): Tile side in image pixels, normally the model input size.
+        overlap (float): Fraction of a tile shared with its neighbour.
+        min_texture (float): Tiles with a lower tile_texture score are skipped; 0 runs every tile.
+        max_tiles (int): Most tiles run per image.
+        batch_size (int): Tiles per forward.
+        cache (ResultCache): Optional cache for the whole-image pass, see detect_images.
+        image_bytes (list[bytes]): Encoded bytes of each image, used as the whole-image cache key.
+
+    Returns:
+        list[dict]: One dict per image mapping model name to a DETECTION_DTYPE
+        array, with boxes in original image pixels.
+    """
+    # Merging with the tiles can drop whole-image boxes, so only the merged results are counted
+    results = detect_images(models, images, conf_threshold, iou_threshold, top_k, cache=cache,
+                            image_bytes=image_bytes, count=False)
+
+    crops = []
+    origins = []
+    owners = []
+    for index, image in enumerate(images):
+        [height, width, _] = image.shape
+        if max(height, width) <= tile_size:
+            continue  # the whole-image pass already saw it at full resolution
+        with timed("tile_select"):
+            xs, ys = tile_offsets(width, tile_size, overlap), tile_offsets(height, tile_size, overlap)
+            tiles = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+            texture = tile_texture(image, tiles, tile_size)
+            order = np.argsort(-texture, kind="stable")
+            order = order[texture[order] >= min_texture][:max_tiles]
+        for x, y in tiles[np.sort(order)]:
+            crops.append(image[y:y + tile_size, x:x + tile_size])
+            origins.append((x, y))
+            owners.append(index)
+
+    if not crops:
+        count_detections(results)
+        return results
+
+    origins = np.array(origins, dtype=np.float32)
+    tile_detections = {model_name: [[] for _ in images] for model_name in models}
+    for start in range(0, len(crops), batch_size):
+        # Crops are at most tile_size on each side, so letterboxing never rescales them
+        with timed("preprocess"):
+            blob, scales = preprocess_images(crops[start:start + batch_size], tile_size)
+        for model_name, model in models.items():
+            with timed("forward", model_name):
+                outputs = model.forward(blob)
+            for row, output in enumerate(outputs):
+                tile = start + row
+                with timed("nms", model_name):
+                    found = decode_outputs(output, conf_threshold, iou_threshold, top_k)
+                scale_x, scale_y = scales[row]
+                origin_x, origin_y = origins[tile]
+                found["x1"] = found["x1"] * scale_x + origin_x
+                found["x2"] = found["x2"] * scale_x + origin_x
+                found["y1"] = found["y1"] * scale_y + origin_y
+                found["y2"] = found["y2"] * scale_y + origin_y
+                tile_detections[model_name][owners[tile]].append(found)
+
+    for index, detections in enumerate(results):
+        for model_name, found in tile_detections.items():
+            if found[index]:
+                with timed("merge", model_name):
+                    detections[model_name] = merge_detections([detections[model_name], *found[index]],
+                                                              iou_threshold, top_k)
+    count_detections(results)
+    return results
+
+def annotate_image(image, detections, draw_threshold=DRAW_THRESHOLD):
+    """
+    Draws detections onto an image in place.
+
+    Args:
+        image (numpy.ndarray): BGR image the detections were made on.
+        detections (dict): Model name to DETECTION_DTYPE array, as returned by detect_images.
+        draw_threshold (float): Only detections at or above this confidence are drawn.
+    """
+    with timed("draw"):
+        for model_name, model_detections in detections.items():
+            for detection in model_detections[model_detections["confidence"] >= draw_threshold]:
+                draw_bounding_box(
+                    image,
+                    int(detection["class_id"]),
+                    float(detection["confidence"]),
+                    round(float(detection["x1"])),
+                    round(float(detection["y1"])),
+                    round(float(detection["x2"])),
+                    round(float(detection["y2"])),
+                    class_dict[model_name]
+                )
+
+def detections_to_json(detections, scale=1.0):
+    """
+    Converts one image's detections into JSON-serializable dicts.
+
+    Args:
+        detections (dict): Model name to DETECTION_DTYPE array, as returned by detect_images.
+        scale (float or tuple): Factor from the detected image's pixels to the original photo's, for
+            images that were decoded at reduced resolution; an (x, y) pair when the axes differ.
+    """
+    scale_x, scale_y = scale if isinstance(scale, tuple) else (scale, scale)
+    return {
+        model_name: [
+            {
+                "class_id": int(detection["class_id"]),
+                "class_name": class_dict[model_name][int(detection["class_id"])],
+                "confidence": float(detection["confidence"]),
+                "box": [float(detection["x1"]) * scale_x, float(detection["y1"]) * scale_y,
+                        float(detection["x2"]) * scale_x, float(detection["y2"]) * scale_y],
+            }
+            for detection in model_detections
+        ]
+        for model_name, model_detections in detections.items()
+    }
+
+def detect_defects(models, input_images, file_path, conf_threshold=CONF_THRESHOLD,
+                   iou_threshold=IOU_THRESHOLD, top_k=TOP_K, batch=True, cache=None, tiled=False):
     """
     Main function to load ONNX models, perform inference, draw bounding boxes, and display the output image.
 
     Args:
-        models (list): List of models initialized as OpenCV dnn objects.
+        models (dict): Model name to ModelPool (or any backend), as filled in by add_model.
         input_images list[str]: list of paths to the image
         file_path (str): the designated folder for the image to be saved.
+        conf_threshold (float): Minimum class score for a detection.
+        iou_threshold (float): IoU threshold for non-maximum suppression.
+        top_k (int): Maximum number of detections kept per model and image.
+        batch (bool): Run all images through each model in one forward instead of one per image.
+        cache (ResultCache): Optional cache of detections keyed by image bytes, model version and thresholds.
+        tiled (bool): Also run full-resolution tiles through the models, see detect_tiled.
+
+    Returns:
+        list[dict]: One dict per input image mapping model name to a DETECTION_DTYPE
+        array, with boxes scaled back to original image pixels.
     """
-    
+    original_images = []
+    image_bytes = []
     for image_path in input_images:
-        # Read the input image
-        original_image = cv2.imread(image_path)
-        [height, width, _] = original_image.shape
+        with open(image_path, "rb") as image_file:
+            image_bytes.append(image_file.read())
+        original_images.append(cv2.imdecode(np.frombuffer(image_bytes[-1], np.uint8), cv2.IMREAD_COLOR))
 
-        # Prepare a square image for inference
-        length = max((height, width))
-        image = np.zeros((length, length, 3), np.uint8)
-        image[0:height, 0:width] = original_image
+    if tiled:
+        results = detect_tiled(models, original_images, conf_threshold, iou_threshold, top_k, cache=cache,
+                               image_bytes=image_bytes)
+    else:
+        results = detect_images(models, original_images, conf_threshold, iou_threshold, top_k, batch, cache,
+                                image_bytes)
 
-        # Calculate scale factor
-        scale = length / 640
+    for image_path, original_image, detections in zip(input_images, original_images, results):
+        # Draw bounding boxes and labels
+        annotate_image(original_image, detections)
 
-        # Perform inference for all models
-        detections = []
-        for model_name, model in models.items():
-            blob = cv2.dnn.blobFromImage(image, scalefactor=1 / 255, size=(640, 640), swapRB=True)
-            model.setInput(blob)
-
-            # Perform inference
-            outputs = model.forward()
-
-            # Prepare output array
-            outputs = np.array([cv2.transpose(outputs[0])])
-            rows = outputs.shape[1]
-
-            boxes = []
-            scores = []
-            class_ids = []
-
-            # Iterate through output to collect bounding boxes, confidence scores, and class IDs
-            for i in range(rows):
-                classes_scores = outputs[0][i][4:]
-                (minScore, maxScore, minClassLoc, (x, maxClassIndex)) = cv2.minMaxLoc(classes_scores)
-                if maxScore >= 0.25:
-                    box = [
-                        outputs[0][i][0] - (0.5 * outputs[0][i][2]),
-                        outputs[0][i][1] - (0.5 * outputs[0][i][3]),
-                        outputs[0][i][2],
-                        outputs[0][i][3],
-                    ]
-                    boxes.append(box)
-                    scores.append(maxScore)
-                    class_ids.append(maxClassIndex)
-
-            # Apply NMS (Non-maximum suppression)
-            result_boxes = cv2.dnn.NMSBoxes(boxes, scores, 0.25, 0.45, 0.5)
-
-            # Iterate through NMS results to draw bounding boxes and labels
-            for i in range(len(result_boxes)):
-                index = result_boxes[i]
-                box = boxes[index]
-                detection = {
-                    "model": model_name,
-                    "class_id": class_ids[index],
-                    "class_name": class_dict[model_name][class_ids[index]],
-                    "confidence": scores[index],
-                    "box": box,
-                    "scale": scale,
-                }
-                detections.append(detection)
-                if detection["confidence"] >=  0.3:
-                    draw_bounding_box(
-                        original_image,
-                        class_ids[index],
-                        scores[index],
-                        round(box[0] * scale),
-                        round(box[1] * scale),
-                        round((box[0] + box[2]) * scale),
-                        round((box[1] + box[3]) * scale),
-                        class_dict[model_name]
-                    )
-
-            # Display the image with bounding boxes
-            print(file_path)
-            print(image_path)
-            writeStatus = cv2.imwrite(os.path.join(file_path , image_path), original_image)
-            if writeStatus is True:
-                print("image written")
-            else:
-                print("problem") # or raise exception, handle problem, etc.
+        # Display the image with bounding boxes
+        output_path = os.path.join(file_path, image_path)
+        log(output_path)
+        writeStatus = cv2.imwrite(output_path, original_image)
+        if writeStatus is True:
+            log("image written", path=output_path)
+        else:
+            log("problem", level=logging.ERROR, path=output_path) # or raise exception, handle problem, etc.
+
+    return results
+
+def check_backend_parity(model_path, input_images, backends=("cv2", "onnxruntime"), atol=1e-3,
+                         conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD):
+    """
+    Runs the same images through several backends and compares their outputs.
+
+    Args:
+        model_path (str): Path to the ONNX weights.
+        input_images list[str]: list of paths to the image
+        backends (tuple[str]): Backend names to compare, the first one is the reference.
+        atol (float): Largest absolute difference in raw outputs that still counts as a match.
+
+    Returns:
+        dict: Per backend, the max absolute output difference against the reference,
+        whether it is within atol, and whether decoded detections agree.
+    """
+    blob, _ = preprocess_images([cv2.imread(image_path) for image_path in input_images])
+    outputs = {name: load_backend(model_path, name).forward(blob) for name in backends}
+
+    reference_name = backends[0]
+    reference = outputs[reference_name]
+    report = {}
+    for name in backends[1:]:
+        difference = float(np.max(np.abs(outputs[name] - reference)))
+        same_detections = True
+        for expected, actual in zip(reference, outputs[name]):
+            expected = decode_outputs(expected, conf_threshold, iou_threshold)
+            actual = decode_outputs(actual, conf_threshold, iou_threshold)
+            if len(expected) != len(actual) or not np.array_equal(expected["class_id"], actual["class_id"]):
+                same_detections = False
+                break
+        report[name] = {
+            "reference": reference_name,
+            "max_abs_diff": difference,
+            "within_tolerance": difference <= atol,
+            "same_detections": same_detections,
+        }
+    return report
 
 if __name__ == "__main__":
     # Define models and their corresponding class YAMLs
@@ -145,8 +617,19 @@ if __name__ == "__main__":
         }
     }
 
-    # Load all models
-    for model_name, paths in models.items():
-        add_model(model_name, paths["weights"], paths["classes"])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--img", nargs="+", default=["stain.png"], help="Path to input images.")
+    parser.add_argument("--backend", default="cv2", choices=sorted(BACKENDS), help="Inference backend.")
+    parser.add_argument("--parity", action="store_true", help="Compare backends instead of running detection.")
+    parser.add_argument("--tiled", action="store_true", help="Also detect on full-resolution tiles.")
+    args = parser.parse_args()
+
+    if args.parity:
+        for model_name, paths in models.items():
+            print(model_name, check_backend_parity(paths["weights"], args.img))
+    else:
+        # Load all models
+        for model_name, paths in models.items():
+            add_model(model_name, paths["weights"], paths["classes"], args.backend)
 
-    detect_defects(model_dict, ["stain.png"], "" )
+        detect_defects(model_dict, args.img, "", tiled=args.tiled)